@@ -0,0 +1,114 @@
+"""
+lets the task runner add, replace and remove databases and reload the metadata
+of the running Datasette process, so that importing one dataset doesn't require a restart.
+
+All endpoints need the token from `ds/.control-token` as `Authorization: Bearer <token>`.
+"""
+import hmac
+import json
+import secrets
+from pathlib import Path
+
+import yaml
+from datasette import hookimpl, Response
+from datasette.database import Database
+
+ds_dir = Path(__file__).resolve().parent.parent
+token_file = ds_dir / ".control-token"
+metadata_file = ds_dir / "metadata.yaml"
+config_file = ds_dir / "datasette.yaml"
+
+
+def control_token() -> str:
+    if not token_file.exists():
+        token_file.touch(mode=0o600)
+        token_file.write_text(secrets.token_hex(32))
+    return token_file.read_text().strip()
+
+
+def is_authorized(request) -> bool:
+    auth = request.headers.get("authorization", "")
+    if not auth.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(auth.removeprefix("Bearer ").strip(), control_token())
+
+
+def forbidden() -> Response:
+    return Response.json({"ok": False, "error": "forbidden"}, status=403)
+
+
+async def database_view(request, datasette):
+    if not is_authorized(request):
+        return forbidden()
+    name = request.url_vars["name"]
+    if "/" in name or name.startswith("."):
+        return Response.json({"ok": False, "error": "invalid name"}, status=400)
+
+    if request.method == "DELETE":
+        remove_database(datasette, name)
+        return Response.json({"ok": True})
+    if request.method != "POST":
+        return Response.json({"ok": False, "error": "method not allowed"}, status=405)
+
+    path = ds_dir / f"{name}.db"
+    if not path.exists():
+        return Response.json({"ok": False, "error": f"{path.name} does not exist"}, status=404)
+    body = await request.post_body()
+    inspect_data = json.loads(body).get("inspect") if body else None
+    if inspect_data:
+        if datasette.inspect_data is None:
+            datasette.inspect_data = {}
+        datasette.inspect_data[name] = inspect_data
+    # the file might have been replaced, so the old connections would still see the old version
+    remove_database(datasette, name)
+    datasette.add_database(Database(datasette, path=str(path), is_mutable=False), name=name)
+    return Response.json({"ok": True})
+
+
+def remove_database(datasette, name: str) -> None:
+    """
+    unlike `datasette.remove_database` the connections aren't closed, as queries may still be running on them
+    """
+    if name not in datasette.databases:
+        return
+    databases = datasette.databases.copy()
+    databases.pop(name)
+    datasette.databases = databases
+
+
+async def metadata_view(request, datasette):
+    if not is_authorized(request):
+        return forbidden()
+    if request.method != "POST":
+        return Response.json({"ok": False, "error": "method not allowed"}, status=405)
+    with metadata_file.open() as f:
+        metadata = yaml.safe_load(f) or {}
+    with config_file.open() as f:
+        # contains the canned queries
+        datasette.config = yaml.safe_load(f) or {}
+
+    internal = datasette.get_internal_database()
+    for table in ["metadata_instance", "metadata_databases", "metadata_resources", "metadata_columns"]:
+        await internal.execute_write(f"DELETE FROM {table}")
+    datasette._metadata_local = metadata
+    await datasette.apply_metadata_json()
+    return Response.json({"ok": True})
+
+
+@hookimpl
+def register_routes():
+    return [
+        (r"^/-/control/databases/(?P<name>[^/]+)$", database_view),
+        (r"^/-/control/metadata$", metadata_view),
+    ]
+
+
+@hookimpl
+def skip_csrf(scope):
+    # the endpoints are called by a script that uses a token instead of cookies
+    return scope["path"].startswith("/-/control/")
+
+
+@hookimpl
+def startup():
+    control_token()
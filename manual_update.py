@@ -3,9 +3,9 @@ from pathlib import Path
 from sqlite_utils import Database
 from sqlite_utils.db import NotFoundError
 
-from meta.fetcher import zstd_file_size
+from meta.compression import compressed_file_size
 from meta.meta_db import meta_db
-from meta.processes import run_datasette_inspect
+from meta.inspect_data import create_inspect_data
 
 for file in Path("ds").glob("*.db"):
     if "meta" in file.name:
@@ -22,18 +22,19 @@ for file in Path("ds").glob("*.db"):
         continue
     db = Database(file)
 
-    db.disable_wal()
-    db.vacuum()
-    db.disable_wal()
-    db.vacuum()
+    # only vacuum if there is something to reclaim, as rewriting the file invalidates the cached compressed size
+    free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+    if db.journal_mode == "wal" or free_pages > 0:
+        db.disable_wal()
+        db.vacuum()
     # https://til.simonwillison.net/sqlite/database-file-size
     curr = db.execute("select page_size * page_count from pragma_page_count(), pragma_page_size()")
     db_size = curr.fetchone()[0]
     db.close()
 
-    inspect_data = run_datasette_inspect(file.name)
+    inspect_data = create_inspect_data(file)
     meta_db.db["records"].update(file.stem, {
         "db_size": db_size,
-        "compressed_size": zstd_file_size(file),
+        "compressed_size": compressed_file_size(file, sample=True),
         "inspect_data": inspect_data,
     })
@@ -0,0 +1,58 @@
+"""
+access the meta database from the async handlers of the web server without blocking the event loop.
+
+Reads run in a small thread pool in which every thread has its own read-only connection,
+so thanks to WAL they run concurrently with each other and with the imports writing to the database.
+Writes all go through a single thread that uses the shared `meta_db` connection,
+as SQLite only allows one writer at a time anyway.
+"""
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, TypeVar
+
+from sqlite_utils import Database
+
+from .meta_db import MetaDatabase, meta_db_file
+
+READ_THREADS = 4
+# readers don't wait for writers in WAL mode, but e.g. for a checkpoint that truncates the log
+BUSY_TIMEOUT = 5
+
+T = TypeVar("T")
+
+read_executor = ThreadPoolExecutor(READ_THREADS, thread_name_prefix="meta-db-read")
+write_executor = ThreadPoolExecutor(1, thread_name_prefix="meta-db-write")
+thread_local = threading.local()
+
+
+def reader() -> MetaDatabase:
+    """
+    the read-only database of the current thread
+    """
+    if not hasattr(thread_local, "meta_db"):
+        conn = sqlite3.connect(meta_db_file.resolve().as_uri() + "?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+        thread_local.meta_db = MetaDatabase(Database(conn), read_only=True)
+    return thread_local.meta_db
+
+
+def call_with_reader(function: Callable[..., T], *args, **kwargs) -> T:
+    return function(reader(), *args, **kwargs)
+
+
+async def read(function: Callable[..., T], *args, **kwargs) -> T:
+    """
+    runs `function(db, *args, **kwargs)` in the read pool, e.g. `await read(MetaDatabase.list_records, page)`
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(read_executor, partial(call_with_reader, function, *args, **kwargs))
+
+
+async def write(function: Callable[..., T], *args, **kwargs) -> T:
+    """
+    runs `function(*args, **kwargs)` in the writer thread, it should use `meta_db` or the task queue
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(write_executor, partial(function, *args, **kwargs))
@@ -0,0 +1,67 @@
+"""
+find out how well a database compresses (which is used for the storage quota)
+without piping the whole file through the zstd binary every time
+"""
+from pathlib import Path
+
+import zstandard
+
+from .meta_db import meta_db
+
+BLOCK_SIZE = 4 * 1024 * 1024
+# same default level as the zstd CLI
+COMPRESSION_LEVEL = 3
+# files larger than this are only sampled if sampling is allowed
+SAMPLE_THRESHOLD = 512 * 1024 * 1024
+NUM_SAMPLES = 32
+
+
+def zstd_file_size(file: Path) -> int:
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compressobj()
+    total = 0
+    with file.open("rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            total += len(compressor.compress(block))
+    total += len(compressor.flush())
+    return total
+
+
+def estimate_zstd_file_size(file: Path, num_samples: int = NUM_SAMPLES) -> int:
+    """
+    compress only a few evenly spaced blocks and extrapolate the compression ratio to the whole file
+    """
+    size = file.stat().st_size
+    if size <= num_samples * BLOCK_SIZE:
+        return zstd_file_size(file)
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    sampled = 0
+    compressed = 0
+    step = (size - BLOCK_SIZE) // (num_samples - 1)
+    with file.open("rb") as f:
+        for i in range(num_samples):
+            f.seek(i * step)
+            block = f.read(BLOCK_SIZE)
+            sampled += len(block)
+            compressed += len(compressor.compress(block))
+    return round(size * compressed / sampled)
+
+
+def compressed_file_size(file: Path, sample: bool = False) -> int:
+    """
+    cached by path, size and modification time, so unchanged files are never compressed twice
+    """
+    stat = file.stat()
+    path = str(file.resolve())
+    cached = meta_db.get_cached_compressed_size(path, stat.st_size, stat.st_mtime_ns, allow_sampled=sample)
+    if cached is not None:
+        return cached
+    sampled = sample and stat.st_size > SAMPLE_THRESHOLD
+    if sampled:
+        size = estimate_zstd_file_size(file)
+    else:
+        size = zstd_file_size(file)
+    meta_db.set_cached_compressed_size(path, stat.st_size, stat.st_mtime_ns, size, sampled)
+    return size
@@ -0,0 +1,54 @@
+"""
+client for the control endpoints of `ds/plugins/control.py`
+
+If Datasette can't be reached that way (e.g. because it is not running or the plugin is missing),
+it is restarted instead.
+"""
+import json
+import os
+from typing import Optional, Iterable
+
+import requests
+
+from .globals import ds_dir
+from .meta_db import meta_db
+from .processes import restart_datasette_process
+
+DATASETTE_URL = os.environ.get("ODE_DATASETTE_URL", "http://127.0.0.1:8001")
+token_file = ds_dir / ".control-token"
+
+
+def control_request(method: str, path: str, data: Optional[dict] = None) -> bool:
+    try:
+        token = token_file.read_text().strip()
+        r = requests.request(method, DATASETTE_URL + path, json=data, timeout=60,
+                             headers={"Authorization": f"Bearer {token}"})
+        r.raise_for_status()
+    except (OSError, requests.RequestException) as e:
+        print(f"control request {method} {path} failed: {e}")
+        return False
+    return True
+
+
+def attach_database(id: str) -> bool:
+    """
+    adds the database or replaces it with the current version of the file
+    """
+    record = meta_db.get_record(id)
+    inspect_data = json.loads(record.inspect_data) if record is not None and record.inspect_data else None
+    return control_request("POST", f"/-/control/databases/{id}", {"inspect": inspect_data})
+
+
+def detach_database(id: str) -> bool:
+    return control_request("DELETE", f"/-/control/databases/{id}")
+
+
+def reload_datasette(changed: Iterable[str] = (), removed: Iterable[str] = (), metadata_changed: bool = True) -> None:
+    """
+    the metadata files need to be written before (see `create_ds_metadata`),
+    they are only reloaded if `metadata_changed`
+    """
+    ok = all([detach_database(id) for id in removed] + [attach_database(id) for id in changed])
+    if ok and (not metadata_changed or control_request("POST", "/-/control/metadata")):
+        return
+    restart_datasette_process()
@@ -0,0 +1,187 @@
+"""
+stream resource downloads into a spooled temporary file, so that
+even resources with a few hundred MB never have to be held in memory completely
+"""
+import hashlib
+import io
+import shutil
+import tempfile
+import threading
+import zipfile
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import PurePosixPath
+from typing import Optional, Iterator, BinaryIO
+from urllib.parse import urlparse
+
+from chardet import UniversalDetector
+from requests import Response
+
+from .progress_logger import RecordLogger
+
+CHUNK_SIZE = 1024 * 1024
+# smaller files stay in memory, larger ones are moved to disk automatically
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
+# chardet is only fed the beginning of the file (roughly the first few thousand lines)
+ENCODING_DETECTION_LIMIT = 1024 * 1024
+# don't overload the (often slow) servers of smaller municipalities with parallel requests
+MAX_DOWNLOADS_PER_HOST = 2
+# files inside ZIP archives that are imported, by extension
+# (not .txt, as those are mostly READMEs or descriptions of the data)
+ARCHIVE_MEMBER_FORMATS = {
+    ".csv": "CSV",
+    ".xlsx": "XLSX",
+    ".xls": "XLS",
+}
+
+
+class Download:
+    def __init__(self, file: BinaryIO, size: int, encoding: Optional[str], content_hash: Optional[str] = None):
+        self.file = file
+        self.size = size
+        self.encoding = encoding
+        self.content_hash = content_hash
+
+    def head(self, num_bytes: int) -> bytes:
+        self.file.seek(0)
+        data = self.file.read(num_bytes)
+        self.file.seek(0)
+        return data
+
+    def is_zip(self) -> bool:
+        return self.head(4) == b"PK\x03\x04"
+
+    @contextmanager
+    def open_binary(self) -> Iterator[io.IOBase]:
+        self.file.seek(0)
+        yield self.file
+
+    @contextmanager
+    def open_text(self, encoding: str) -> Iterator[io.TextIOWrapper]:
+        self.file.seek(0)
+        text_file = io.TextIOWrapper(self.file, encoding=encoding, errors="ignore", newline="")
+        try:
+            yield text_file
+        finally:
+            # don't let the wrapper close the underlying file
+            text_file.detach()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HostLimiter:
+    def __init__(self, max_per_host: int = MAX_DOWNLOADS_PER_HOST):
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.semaphores: dict[str, threading.BoundedSemaphore] = defaultdict(
+            lambda: threading.BoundedSemaphore(self.max_per_host)
+        )
+
+    @contextmanager
+    def limit(self, url: str):
+        host = urlparse(url).hostname
+        with self.lock:
+            semaphore = self.semaphores[host]
+        with semaphore:
+            yield
+
+
+host_limiter = HostLimiter()
+
+
+def download_response(r: Response, logger: RecordLogger, detect_encoding: bool = True,
+                      file: Optional[BinaryIO] = None) -> Download:
+    """
+    write a response (requested with `stream=True`) chunk by chunk to a spooled file
+    (or `file` if one is passed) and guess the encoding from the first chunks while doing so.
+    The content is also hashed to be able to detect unchanged resources.
+    """
+    r.raise_for_status()
+    f = file if file is not None else tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    detector = UniversalDetector() if detect_encoding else None
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            if not chunk:
+                continue
+            f.write(chunk)
+            hasher.update(chunk)
+            if detector is not None and not detector.done and size < ENCODING_DETECTION_LIMIT:
+                detector.feed(chunk)
+            size += len(chunk)
+    except BaseException:
+        f.close()
+        raise
+    finally:
+        r.close()
+    f.seek(0)
+    logger.set_status(f"downloaded {size} bytes")
+
+    encoding = None
+    if detector is not None:
+        detector.close()
+        logger.set_status(f"guess result: {detector.result}")
+        encoding = detector.result["encoding"]
+    return Download(f, size, encoding, hasher.hexdigest())
+
+
+def detect_encoding(file: BinaryIO) -> Optional[str]:
+    detector = UniversalDetector()
+    size = 0
+    while size < ENCODING_DETECTION_LIMIT and not detector.done:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        detector.feed(chunk)
+        size += len(chunk)
+    detector.close()
+    file.seek(0)
+    return detector.result["encoding"]
+
+
+def is_workbook(download: Download) -> bool:
+    """
+    XLSX files are ZIP archives as well, but they always contain this file
+    """
+    with zipfile.ZipFile(download.file) as archive:
+        is_xlsx = "[Content_Types].xml" in archive.namelist()
+    download.file.seek(0)
+    return is_xlsx
+
+
+def iter_archive_members(download: Download, logger: RecordLogger) -> Iterator[tuple[str, str, Download]]:
+    """
+    yields (member name, format, download) for every CSV and Excel file in a ZIP archive.
+
+    CSV members are decompressed on the fly (seeking back to the start simply decompresses them again),
+    Excel members need random access and are spooled to a temporary file first.
+    """
+    with zipfile.ZipFile(download.file) as archive:
+        for info in archive.infolist():
+            path = PurePosixPath(info.filename)
+            if info.is_dir() or path.parts[0] == "__MACOSX" or path.name.startswith("."):
+                continue
+            format = ARCHIVE_MEMBER_FORMATS.get(path.suffix.lower())
+            if format is None:
+                logger.set_status(f"skipping {info.filename} in archive")
+                continue
+            member = archive.open(info)
+            if format == "CSV":
+                file = member
+                encoding = detect_encoding(member)
+            else:
+                file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                with member:
+                    shutil.copyfileobj(member, file, CHUNK_SIZE)
+                file.seek(0)
+                encoding = None
+            with Download(file, info.file_size, encoding) as member_download:
+                yield info.filename, format, member_download
@@ -1,12 +1,14 @@
 import json
+import os
+from pathlib import Path
 from typing import Optional
 
 import yaml
 from pydantic import BaseModel
 
-from meta.processes import restart_datasette_process
+from .datasette_control import reload_datasette
 from .globals import root_dir
-from .meta_db import meta_db
+from .meta_db import meta_db, RecordView
 from .utils import merge_models, Url, pretty_byte_size
 
 metadata_dir = root_dir / "metadata"
@@ -16,6 +18,8 @@ tweaks_schema_file = tweaks_dir / "schema.json"
 metadata_output_file = root_dir / "ds" / "metadata.yaml"
 datasette_conf_output_file = root_dir / "ds" / "datasette.yaml"
 inspect_output_file = root_dir / "ds" / "inspect-data.json"
+# increase when the way the metadata of a database is built changes, to not use outdated cached fragments
+FRAGMENT_VERSION = 1
 
 
 class CannedQuery(BaseModel):
@@ -69,6 +73,10 @@ class MetaData(BaseModel):
 class TableTweaks(BaseModel):
     additional_indices: Optional[list[tuple[str, ...]]] = None
     fts_indices: Optional[list[tuple[str, ...]]] = None
+    # set to false to not add full-text search automatically
+    auto_fts: bool = True
+    # e.g. "trigram" to also find parts of (German) compound words
+    fts_tokenizer: Optional[str] = None
 
 
 class CSVDialectTweak(BaseModel):
@@ -93,84 +101,144 @@ class Tweaks(BaseModel):
     resources: dict[str, ResourceTweaks] = {}
 
 
-def create_schema_file():
-    with schema_file.open("w") as f:
-        print(type(DatabaseMeta.model_json_schema()))
-        json.dump(DatabaseMeta.model_json_schema(), f, indent=2, ensure_ascii=False)
-    with tweaks_schema_file.open("w") as f:
-        print(type(Tweaks.model_json_schema()))
-        json.dump(Tweaks.model_json_schema(), f, indent=2, ensure_ascii=False)
+def write_if_changed(file: Path, content: str) -> bool:
+    """
+    replaces the file atomically, but only if the content actually changed
+    """
+    try:
+        if file.read_text() == content:
+            return False
+    except FileNotFoundError:
+        pass
+    tmp_file = file.with_name(f".{file.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(content)
+    os.replace(tmp_file, file)
+    return True
 
 
-def create_ds_metadata():
-    create_schema_file()
-    metadata = MetaData()
-    with (metadata_dir / "datasette.yaml").open() as f:
-        datasette_conf = yaml.safe_load(f)
-        datasette_conf["databases"] = {}
-    inspect_data = {}
-
-    for record in meta_db.get_records():
-        inspect_data[record.id] = record.inspect_data
-        db_description = record.notes
-        db_description += f"\n\n({pretty_byte_size(record.db_size)}, {pretty_byte_size(record.compressed_size)} komprimiert)"
-        db_meta = DatabaseMeta(
+def create_schema_file():
+    write_if_changed(schema_file, json.dumps(DatabaseMeta.model_json_schema(), indent=2, ensure_ascii=False))
+    write_if_changed(tweaks_schema_file, json.dumps(Tweaks.model_json_schema(), indent=2, ensure_ascii=False))
+
+
+def build_database_meta(record: RecordView) -> DatabaseMeta:
+    db_description = record.notes
+    db_description += f"\n\n({pretty_byte_size(record.db_size)}, {pretty_byte_size(record.compressed_size)} komprimiert)"
+    db_meta = DatabaseMeta(
+        source=record.publisher,
+        source_url=record.datagvurl,
+        license=record.license_title,
+        license_url=record.license_url,
+        about=record.maintainer,
+        about_url=record.metadata_linkage,
+        title=record.title,
+        description=db_description,  # add more in the future
+    )
+    for resource in record.resources:
+        res_meta = TableMeta(
             source=record.publisher,
             source_url=record.datagvurl,
             license=record.license_title,
             license_url=record.license_url,
             about=record.maintainer,
             about_url=record.metadata_linkage,
-            title=record.title,
-            description=db_description,  # add more in the future
         )
-        for resource in meta_db.get_resources(record):
-            res_meta = TableMeta(
-                source=record.publisher,
-                source_url=record.datagvurl,
-                license=record.license_title,
-                license_url=record.license_url,
-                about=record.maintainer,
-                about_url=record.metadata_linkage,
-            )
-            db_meta.tables[resource.name] = res_meta
-        override_file = metadata_dir / f"{record.id}.yaml"
-        if override_file.exists():
-            with override_file.open() as f:
-                data = yaml.safe_load(f)
-
-                metadata_from_file = DatabaseMeta(**data)
-                print("overriding from file")
-                print(metadata_from_file)
-                db_meta = merge_models(db_meta, metadata_from_file)
-        metadata.databases[record.id] = db_meta
+        db_meta.tables[resource.name] = res_meta
+    override_file = metadata_dir / f"{record.id}.yaml"
+    if override_file.exists():
+        with override_file.open() as f:
+            data = yaml.safe_load(f)
+
+            metadata_from_file = DatabaseMeta(**data)
+            print("overriding from file")
+            print(metadata_from_file)
+            db_meta = merge_models(db_meta, metadata_from_file)
+    return db_meta
+
+
+def indent(text: str) -> str:
+    return "".join("  " + line for line in text.splitlines(keepends=True))
+
+
+def render_fragment(db_id: str, db_meta: DatabaseMeta) -> tuple[str, Optional[str]]:
+    """
+    the YAML of this database in metadata.yaml and (if it has canned queries) in datasette.yaml,
+    already indented to be placed below `databases:`
+    """
+    queries = None
+    if db_meta.queries is not None:
+        queries = indent(yaml.dump({db_id: {
+            "queries": {k: v.model_dump(exclude_none=True) for k, v in db_meta.queries.items()}
+        }}, sort_keys=False))
+        db_meta.queries = None
+    metadata = indent(yaml.dump({db_id: db_meta.model_dump(exclude_none=True)}, sort_keys=False))
+    return metadata, queries
+
+
+def splice_databases(head: str, fragments: list[str]) -> str:
+    if not fragments:
+        return head + "databases: {}\n"
+    return head + "databases:\n" + "".join(fragments)
+
+
+def create_ds_metadata() -> bool:
+    """
+    only the fragments of records that changed since the last run are built again
+    (depending on metadata_modified, the override file and the database itself),
+    the output files are then spliced together from the cached fragments.
+
+    Returns whether any of the output files changed.
+    """
+    create_schema_file()
+    override_mtimes = {f.stem: f.stat().st_mtime_ns for f in metadata_dir.glob("*.yaml")}
+    cached_keys = meta_db.get_metadata_fragment_keys()
+    record_ids = []
+    changed_keys = {}
+    for id, metadata_modified, db_size, compressed_size, db_hash in meta_db.get_record_versions():
+        record_ids.append(id)
+        cache_key = json.dumps([
+            FRAGMENT_VERSION, metadata_modified, override_mtimes.get(id), db_hash, db_size, compressed_size
+        ])
+        if cached_keys.get(id) != cache_key:
+            changed_keys[id] = cache_key
+    if changed_keys:
+        # the API data is not needed for the metadata
+        columns = ["title", "publisher", "notes", "license_title", "license_url", "maintainer", "metadata_linkage",
+                   "db_size", "compressed_size", "inspect_data"]
+        for record in meta_db.get_record_views(ids=list(changed_keys), columns=columns):
+            metadata, queries = render_fragment(record.id, build_database_meta(record))
+            meta_db.set_metadata_fragment(record.id, changed_keys[record.id], metadata, queries, record.inspect_data)
+    meta_db.delete_metadata_fragments(set(record_ids))
+    fragments = meta_db.get_metadata_fragments(record_ids)
 
     with (metadata_dir / "meta_db.yaml").open() as f:
         data = yaml.safe_load(f)
-        metadata_from_file = DatabaseMeta(**data)
-        metadata.databases["meta_db"] = metadata_from_file
+        meta_db_meta = DatabaseMeta(**data)
+    meta_db_metadata, meta_db_queries = render_fragment("meta_db", meta_db_meta)
 
-    for db_id, db_meta in metadata.databases.items():
-        if db_meta.queries is not None:
-            datasette_conf["databases"][db_id] = {
-                "queries": {k: v.model_dump(exclude_none=True) for k, v in db_meta.queries.items()}
-            }
-            metadata.databases[db_id].queries = None
+    metadata_fragments = [metadata for _, metadata, _, _ in fragments] + [meta_db_metadata]
+    query_fragments = [queries for _, _, queries, _ in fragments] + [meta_db_queries]
 
-    with metadata_output_file.open("w") as f:
-        yaml.dump(metadata.model_dump(exclude_none=True), f, sort_keys=False)
-    with datasette_conf_output_file.open("w") as f:
-        yaml.dump(datasette_conf, f, sort_keys=False)
+    with (metadata_dir / "datasette.yaml").open() as f:
+        datasette_conf = yaml.safe_load(f)
+        datasette_conf.pop("databases", None)
 
-    inspect_dict = {}
-    for id, insp_str in inspect_data.items():
-        insp_data = json.loads(insp_str)
-        inspect_dict[id] = insp_data
+    # the inspect data is stored as JSON already
+    inspect_json = ",\n".join(
+        f"  {json.dumps(id)}: {inspect_data}" for id, _, _, inspect_data in fragments if inspect_data is not None
+    )
 
-    with inspect_output_file.open("w") as f:
-        json.dump(inspect_dict, f, indent=2, ensure_ascii=False)
+    # there is no instance-wide metadata (yet), so metadata.yaml only consists of the databases
+    changed = write_if_changed(metadata_output_file, splice_databases("", metadata_fragments))
+    changed |= write_if_changed(
+        datasette_conf_output_file,
+        splice_databases(yaml.dump(datasette_conf, sort_keys=False),
+                         [queries for queries in query_fragments if queries is not None])
+    )
+    changed |= write_if_changed(inspect_output_file, "{\n" + inspect_json + "\n}\n")
+    return changed
 
 
 if __name__ == '__main__':
     create_ds_metadata()
-    restart_datasette_process()
+    reload_datasette()
@@ -0,0 +1,202 @@
+"""
+export every table of a dataset once as Parquet and zstd-compressed CSV,
+so that bulk downloads are just static files instead of thousands of paginated queries.
+
+The exports of a dataset live in `ds/exports/{id}/` together with a manifest that records
+the hash of the database file they were created from.
+"""
+import csv
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
+
+from .compression import COMPRESSION_LEVEL
+from .globals import ds_dir
+from .loader import quote_identifier
+from .progress_logger import RecordLogger
+
+exports_dir = ds_dir / "exports"
+MANIFEST_FILE = "manifest.json"
+EXPORT_BATCH_SIZE = 100_000
+
+# the values that are allowed in a column with the declared type,
+# otherwise it is exported as binary (if it contains BLOBs) or as text
+ARROW_TYPES = {
+    "INTEGER": (pa.int64(), ("integer",)),
+    "REAL": (pa.float64(), ("real", "integer")),
+    "FLOAT": (pa.float64(), ("real", "integer")),
+    "BLOB": (pa.binary(), ("blob",)),
+}
+
+
+def export_dir(id: str) -> Path:
+    return exports_dir / id
+
+
+def safe_file_name(name: str) -> str:
+    return re.sub(r"[^\w\-. ]", "_", name).strip(". ") or "table"
+
+
+def read_manifest(id: str) -> Optional[dict]:
+    try:
+        with (export_dir(id) / MANIFEST_FILE).open() as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def current_exports(id: str, db_hash: str) -> Optional[dict]:
+    """
+    the manifest, but only if the exports belong to this version of the database
+    """
+    manifest = read_manifest(id)
+    if manifest is None or manifest.get("hash") != db_hash:
+        return None
+    return manifest
+
+
+def exported_tables(conn: sqlite3.Connection) -> list[str]:
+    # virtual tables (FTS, R*Tree) and their shadow tables are only indices
+    return [
+        row[0] for row in
+        conn.execute("SELECT name FROM pragma_table_list WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    ]
+
+
+def arrow_schema(conn: sqlite3.Connection, table: str) -> pa.Schema:
+    """
+    use the declared types unless a column also contains values of other types
+    (which SQLite allows, e.g. in tables not created by our loader)
+    """
+    columns = [(row[1], row[2].upper()) for row in conn.execute(f"PRAGMA table_info({quote_identifier(table)})")]
+    checks = []
+    for column, declared in columns:
+        allowed = ARROW_TYPES.get(declared, (None, ()))[1] + ("null",)
+        checks.append("max(typeof({}) NOT IN ({}))".format(
+            quote_identifier(column), ", ".join(f"'{t}'" for t in allowed)
+        ))
+        checks.append(f"max(typeof({quote_identifier(column)}) = 'blob')")
+    result = conn.execute(f"SELECT {', '.join(checks)} FROM {quote_identifier(table)}").fetchone()
+    fields = []
+    for (column, declared), is_mixed, has_blobs in zip(columns, result[::2], result[1::2]):
+        if declared in ARROW_TYPES and not is_mixed:
+            fields.append(pa.field(column, ARROW_TYPES[declared][0]))
+        elif has_blobs:
+            fields.append(pa.field(column, pa.binary()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+def to_arrow_batch(rows: list[tuple], schema: pa.Schema) -> pa.RecordBatch:
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if field.type == pa.string():
+            values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+        elif field.type == pa.binary():
+            values = [v if v is None or isinstance(v, bytes) else str(v).encode() for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def hex_blobs(rows: list[tuple], binary_columns: list[int]) -> list[list]:
+    """
+    CSV has no binary values, so BLOBs are written as hex
+    """
+    converted = []
+    for row in rows:
+        row = list(row)
+        for i in binary_columns:
+            if isinstance(row[i], bytes):
+                row[i] = row[i].hex()
+        converted.append(row)
+    return converted
+
+
+def export_table(conn: sqlite3.Connection, table: str, parquet_file: Path, csv_file: Path) -> int:
+    """
+    writes both files in a single pass over the table
+    """
+    schema = arrow_schema(conn, table)
+    binary_columns = [i for i, field in enumerate(schema) if field.type == pa.binary()]
+    cursor = conn.execute(f"SELECT * FROM {quote_identifier(table)}")
+    num_rows = 0
+    with pq.ParquetWriter(parquet_file, schema, compression="zstd") as parquet_writer, \
+            csv_file.open("wb") as raw_csv:
+        compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+        with compressor.stream_writer(raw_csv, closefd=False) as zstd_writer:
+            text = io.TextIOWrapper(zstd_writer, encoding="utf-8", newline="")
+            writer = csv.writer(text)
+            writer.writerow(schema.names)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                parquet_writer.write_batch(to_arrow_batch(rows, schema))
+                writer.writerows(hex_blobs(rows, binary_columns) if binary_columns else rows)
+                num_rows += len(rows)
+            text.flush()
+            text.detach()
+    return num_rows
+
+
+def create_exports(id: str, db_file: Path, db_hash: str, logger: RecordLogger) -> dict:
+    """
+    does nothing if the exports for this version of the database already exist
+    """
+    manifest = current_exports(id, db_hash)
+    if manifest is not None:
+        return manifest
+    exports_dir.mkdir(exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=exports_dir, prefix=f".{id}-"))
+    try:
+        manifest = {"hash": db_hash, "tables": {}}
+        conn = sqlite3.connect(db_file.resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            used_names = set()
+            for table in exported_tables(conn):
+                logger.set_status(f"exporting {table}")
+                name = safe_file_name(table)
+                suffix = 2
+                while name.lower() in used_names:
+                    name = f"{safe_file_name(table)}_{suffix}"
+                    suffix += 1
+                used_names.add(name.lower())
+                parquet_name = name + ".parquet"
+                csv_name = name + ".csv.zst"
+                num_rows = export_table(conn, table, tmp_dir / parquet_name, tmp_dir / csv_name)
+                manifest["tables"][table] = {
+                    "rows": num_rows,
+                    "parquet": parquet_name,
+                    "parquet_size": (tmp_dir / parquet_name).stat().st_size,
+                    "csv": csv_name,
+                    "csv_size": (tmp_dir / csv_name).stat().st_size,
+                }
+        finally:
+            conn.close()
+        with (tmp_dir / MANIFEST_FILE).open("w") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        delete_exports(id)
+        os.replace(tmp_dir, export_dir(id))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return manifest
+
+
+def exports_size(manifest: dict) -> int:
+    return sum(table["parquet_size"] + table["csv_size"] for table in manifest["tables"].values())
+
+
+def delete_exports(id: str) -> None:
+    shutil.rmtree(export_dir(id), ignore_errors=True)
@@ -1,28 +1,50 @@
 import csv
-import subprocess
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
 import sys
 import tempfile
-from io import BytesIO
-from pathlib import Path
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import Optional, Iterable, Sequence, Any, Iterator, BinaryIO, Callable
 from urllib.parse import urlparse
 
-import pandas as pd
+import openpyxl
+import xlrd
 import yaml
-from chardet import UniversalDetector
 from requests import Response
 from sqlite_utils import Database
-from sqlite_utils.utils import file_progress, TypeTracker
 
 from meta import create_ds_metadata
 from meta.ds_metadata import Tweaks, TableTweaks, ResourceTweaks, CSVDialectTweak
 from meta.hardcoded_fixes import fix_url, format_normalizer
 from meta.parlament import import_parlament
 from meta.site_specific.nextcloud import get_nextcloud_shared_url
+from .compression import compressed_file_size
 from .datagv import get_datagv_metadata
-from .globals import s, ds_dir, tweaks_dir
-from .meta_db import meta_db
-from .processes import run_datasette_inspect, restart_datasette_process
-from .progress_logger import RecordLogger
+from .download import Download, download_response, host_limiter, is_workbook, iter_archive_members
+from .exports import create_exports, delete_exports, exports_size
+from .fts import choose_fts_columns, build_fts
+from .geo import GEO_FORMATS, GeoJSONError, import_geojson, create_spatial_index, wfs_geojson_url, is_wfs_get_feature
+from .globals import download_session, ds_dir, tweaks_dir
+from .loader import load_table, copy_tables, LOADER_VERSION
+from .meta_db import meta_db, Resource, ColumnStats
+from .inspect_data import create_inspect_data
+from .datasette_control import reload_datasette
+from .progress_logger import RecordLogger, get_cancel_event, set_cancel_event
+from .statistics import TableStatistics, merge_statistics, to_column_stats, from_column_stats
+
+# download and import datasets with multiple resources in parallel
+CONCURRENT_FETCH = True
+MAX_DOWNLOAD_THREADS = 8
+MAX_IMPORT_PROCESSES = min(4, os.cpu_count() or 1)
+# Parquet and CSV files of every table for bulk downloads
+CREATE_EXPORTS = True
 
 
 def allowed_fetch_url(url: str) -> bool:
@@ -40,24 +62,6 @@ def allowed_fetch_url(url: str) -> bool:
     return False
 
 
-def zstd_file_size(file: Path):
-    proc = subprocess.Popen([
-        "zstd", "-c", str(file),
-    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    total = 0
-    assert proc.stdout is not None
-
-    while True:
-        chunk = proc.stdout.read(8192)
-        if not chunk:
-            break
-        total += len(chunk)
-    ret = proc.wait()
-    if ret != 0:
-        raise RuntimeError(f"zstd returned {ret}")
-    return total
-
-
 def create_csv_dialect(t_dialect: CSVDialectTweak) -> type(csv.Dialect):
     class CustomDialect(csv.Dialect):
         ...
@@ -74,28 +78,20 @@ def create_csv_dialect(t_dialect: CSVDialectTweak) -> type(csv.Dialect):
     return CustomDialect
 
 
-def import_csv(db: Database, r: Response, logger: RecordLogger, name: str, tweaks: ResourceTweaks):
-    with tempfile.TemporaryFile("w+") as f:
-        if tweaks.encoding is not None:
-            logger
-            encoding = tweaks.encoding
-        else:
-            logger.set_status(f"guessing encoding")
-            detector = UniversalDetector()
-            for line in r.content.splitlines()[:1000]:
-                detector.feed(line)
-                if detector.done:
-                    break
-            detector.close()
-            logger.set_status(f"guess result: {detector.result}")
-
-            encoding = detector.result["encoding"]
-        f.write(r.content.decode(encoding, "ignore"))
+def import_csv(db: Database, download: Download, logger: RecordLogger, name: str, tweaks: ResourceTweaks,
+               stats: dict[str, TableStatistics]):
+    if tweaks.encoding is not None:
+        encoding = tweaks.encoding
+    elif download.encoding is not None:
+        encoding = download.encoding
+    else:
+        logger.set_status(f"could not guess encoding, falling back to UTF-8")
+        encoding = "utf-8"
 
+    with download.open_text(encoding) as f:
         if tweaks.csv_dialect is not None:
             dialect = create_csv_dialect(tweaks.csv_dialect)
         else:
-            f.seek(0)
             logger.set_status(f"guessing CSV type")
             start = f.read(4048)
             dialect = csv.Sniffer().sniff(start)
@@ -107,59 +103,430 @@ def import_csv(db: Database, r: Response, logger: RecordLogger, name: str, tweak
         print(dialect)
         print(dialect.__dict__)
         f.seek(0)
-        with file_progress(f) as f_prog:
-            reader = csv.reader(f_prog, dialect)
-            first_row = next(reader)
+        header = next(csv.reader(f, dialect))
 
-            def clean_row(row):
-                # print(row)
-                row = list(map(lambda x: x.replace(",", "."), row))
-                # print(row)
-                # exit()
-                return row
+        def rows():
+            f.seek(0)
+            reader = csv.reader(f, dialect)
+            next(reader)
+            return reader
 
-            logger.set_status(f"reading CSV file")
+        logger.set_status(f"reading CSV file")
+        merge_statistics(stats, {name: load_table(db, name, header, rows, logger)})
+    return encoding
 
-            docs = (dict(zip(first_row, clean_row(row))) for row in reader)
-            logger.set_status(f"detecting types")
 
-            tracker = TypeTracker()
-            docs = tracker.wrap(docs)
-            logger.set_status(f"detected types: {tracker.types}")
+def non_empty_rows(rows: Iterable[Sequence[Any]]) -> Iterator[Sequence[Any]]:
+    return (row for row in rows if any(value is not None and value != "" for value in row))
 
-            db[name].insert_all(docs)
-            db[name].transform(types=tracker.types)
-    return encoding
 
+def iter_xlsx_sheets(file: BinaryIO) -> Iterator[tuple[str, Sequence[Any], Callable[[], Iterable[Sequence[Any]]]]]:
+    """
+    yields (sheet name, header, rows) for every sheet without loading the whole workbook
+    """
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            # the dimensions stored in the file are often wrong, so read until the end of the sheet instead
+            ws.reset_dimensions()
+            header = next(non_empty_rows(ws.iter_rows(min_row=1, values_only=True)), None)
+            if header is None:
+                continue
+
+            def rows(ws=ws):
+                sheet_rows = non_empty_rows(ws.iter_rows(min_row=1, values_only=True))
+                next(sheet_rows)
+                return sheet_rows
+
+            yield ws.title, header, rows
+    finally:
+        wb.close()
 
-def import_xlsx(db: Database, r: Response, logger: RecordLogger, name: str, i: int, num_res: int):
+
+def iter_xls_sheets(file: BinaryIO) -> Iterator[tuple[str, Sequence[Any], Callable[[], Iterable[Sequence[Any]]]]]:
+    """
+    the old XLS format is limited to 65536 rows, so it is fine to read the file at once,
+    but only one sheet is parsed at a time
+    """
+    book = xlrd.open_workbook(file_contents=file.read(), on_demand=True)
+    try:
+        for index in range(book.nsheets):
+            sheet = book.sheet_by_index(index)
+
+            def row_values(row_index: int, sheet=sheet) -> list[Any]:
+                values = []
+                for cell in sheet.row(row_index):
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        values.append(xlrd.xldate_as_datetime(cell.value, book.datemode))
+                    elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                        values.append(None)
+                    else:
+                        values.append(cell.value)
+                return values
+
+            def all_rows(sheet=sheet, row_values=row_values):
+                return non_empty_rows(row_values(r) for r in range(sheet.nrows))
+
+            header = next(all_rows(), None)
+            if header is not None:
+                def rows(all_rows=all_rows):
+                    sheet_rows = all_rows()
+                    next(sheet_rows)
+                    return sheet_rows
+
+                yield sheet.name, header, rows
+            book.unload_sheet(index)
+    finally:
+        book.release_resources()
+
+
+def import_xlsx(db: Database, download: Download, logger: RecordLogger, name: str, i: int, num_res: int,
+                stats: dict[str, TableStatistics]) -> None:
+    """
+    the row counts of the sheets end up in `stats`
+    """
     logger.set_status(f"reading Excel file {i}/{num_res}")
-    excel_data = BytesIO(r.content)
-    dfs = pd.read_excel(excel_data, sheet_name=None)
-    for table, df in dfs.items():
-        print(df.head)
-        df.to_sql(name + "_" + table, db.conn)
+    with download.open_binary() as excel_data:
+        # XLSX files are ZIP archives, XLS files use the old binary format
+        if download.is_zip():
+            sheets = iter_xlsx_sheets(excel_data)
+        else:
+            sheets = iter_xls_sheets(excel_data)
+        for sheet_name, header, rows in sheets:
+            table = name + "_" + sheet_name
+            logger.set_status(f"reading sheet {sheet_name}")
+            table_stats = load_table(db, table, header, rows, logger)
+            merge_statistics(stats, {table: table_stats})
+            logger.set_status(f"read {table_stats.row_count} rows from sheet {sheet_name}")
+
+
+def request_resource(resource: Resource, tweaks: Tweaks, logger: RecordLogger,
+                     headers: Optional[dict[str, str]] = None) -> Response:
+    headers = dict(headers or {})
+    if "index.php/s/" in resource.url:
+        # nextcloud shared folder
+        r = get_nextcloud_shared_url(resource.url, logger)
+    else:
+        if tweaks.custom_user_agent:
+            print(tweaks.custom_user_agent)
+            headers["User-Agent"] = tweaks.custom_user_agent
+        r = download_session.get(resource.url, headers=headers, stream=True)
+    resource.etag = r.headers.get("ETag")
+    resource.last_modified = r.headers.get("Last-Modified")
+    return r
+
+
+def import_version(resource_tweaks: ResourceTweaks) -> str:
+    data = f"{LOADER_VERSION}:{resource_tweaks.model_dump_json()}"
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+class PreviousImport:
+    """
+    the last import of a dataset: resources that didn't change since then
+    are not imported again, but their tables are copied from the previous database file
+    """
+
+    def __init__(self, db_file: Path, resources: list[Resource], column_stats: list[ColumnStats]):
+        self.db_file = db_file
+        self.resources = {r.id: r for r in resources if r.tables}
+        self.stats = from_column_stats(column_stats)
+
+    def get_resource(self, resource: Resource) -> Optional[Resource]:
+        previous = self.resources.get(resource.id)
+        if previous is None or previous.url != resource.url:
+            return None
+        # the tables would look different now, e.g. after fixing the CSV dialect in the tweaks
+        if previous.import_version != resource.import_version:
+            return None
+        return previous
+
+    def request_headers(self, resource: Resource) -> dict[str, str]:
+        previous = self.get_resource(resource)
+        headers = {}
+        if previous is None:
+            return headers
+        if previous.etag:
+            headers["If-None-Match"] = previous.etag
+        if previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+        return headers
+
+    def is_unchanged(self, resource: Resource, r: Response, content_hash: Optional[str] = None) -> bool:
+        previous = self.get_resource(resource)
+        if previous is None:
+            return False
+        if r.status_code == 304:
+            return True
+        return content_hash is not None and content_hash == previous.content_hash
+
+    def reuse(self, db: Database, resource: Resource, logger: RecordLogger, stats: dict[str, TableStatistics]) -> None:
+        previous = self.get_resource(resource)
+        logger.set_status(f"{resource.name} is unchanged, copying {previous.tables} from the previous import")
+        copy_tables(db, self.db_file, previous.tables)
+        merge_statistics(stats, {table: self.stats[table] for table in previous.tables if table in self.stats})
+        resource.tables = previous.tables
+        resource.encoding = previous.encoding
+        resource.etag = resource.etag or previous.etag
+        resource.last_modified = resource.last_modified or previous.last_modified
+        resource.content_length = resource.content_length or previous.content_length
+        resource.content_hash = resource.content_hash or previous.content_hash
+
+
+def import_file(db: Database, download: Download, logger: RecordLogger, name: str, format: str,
+                resource_tweaks: ResourceTweaks, i: int, num_res: int,
+                stats: dict[str, TableStatistics]) -> Optional[str]:
+    """
+    returns the encoding (or format) of the file or None if it was skipped
+    """
+    if format == "CSV":
+        return import_csv(db, download, logger, name, resource_tweaks, stats)
+    elif format in ["XLSX", "XLS"]:
+        import_xlsx(db, download, logger, name, i, num_res, stats)
+        return format
+    elif format in GEO_FORMATS:
+        try:
+            import_geojson(db, download, logger, name, stats)
+        except GeoJSONError as e:
+            logger.set_status(f"skipping {name}: {e}")
+            return None
+        return format
+    else:
+        raise RuntimeError(f"unsupported format {format}")
+
+
+def import_archive(db: Database, download: Download, logger: RecordLogger, name: str,
+                   resource_tweaks: ResourceTweaks, i: int, num_res: int, stats: dict[str, TableStatistics]) -> None:
+    """
+    every CSV/Excel file in the archive becomes its own table
+    """
+    logger.set_status(f"reading ZIP archive {i}/{num_res}")
+    used_tables = set()
+    for member, format, member_download in iter_archive_members(download, logger):
+        logger.set_status(f"importing {member}")
+        path = PurePosixPath(member)
+        table = name + "_" + path.stem
+        if table.lower() in used_tables:
+            # files with the same name in different folders
+            table = name + "_" + "_".join(path.with_suffix("").parts)
+        candidate = table
+        suffix = 2
+        while candidate.lower() in used_tables:
+            candidate = f"{table}_{suffix}"
+            suffix += 1
+        table = candidate
+        used_tables.add(table.lower())
+        import_file(db, member_download, logger, table, format, resource_tweaks, i, num_res, stats)
+
+
+def import_download(db: Database, download: Download, logger: RecordLogger, resource: Resource,
+                    resource_tweaks: ResourceTweaks, i: int, num_res: int,
+                    stats: dict[str, TableStatistics]) -> Optional[str]:
+    """
+    returns the encoding of the resource or None if it was skipped
+    """
+    format = resource.format
+    logger.set_status(f"importing resource {i}/{num_res}")
+    if download.is_zip():
+        if is_workbook(download):
+            format = "XLSX"
+        else:
+            import_archive(db, download, logger, resource.name, resource_tweaks, i, num_res, stats)
+            return "ZIP"
+    return import_file(db, download, logger, resource.name, format, resource_tweaks, i, num_res, stats)
+
+
+@dataclass
+class StagedResource:
+    """
+    a resource that is downloaded and imported into its own SQLite file
+    before it is merged into the dataset database
+    """
+    i: int
+    resource: Resource
+    resource_tweaks: ResourceTweaks
+    download_file: Path
+    staging_db: Path
+    size: int = 0
+    encoding: Optional[str] = None
+    unchanged: bool = False
+
+
+def download_to_staging(staged: StagedResource, tweaks: Tweaks, logger: RecordLogger,
+                        previous: Optional[PreviousImport]) -> StagedResource:
+    resource = staged.resource
+    with host_limiter.limit(resource.url):
+        headers = previous.request_headers(resource) if previous is not None else None
+        r = request_resource(resource, tweaks, logger, headers)
+        if previous is not None and previous.is_unchanged(resource, r):
+            r.close()
+            staged.unchanged = True
+            return staged
+        with staged.download_file.open("w+b") as f:
+            download = download_response(r, logger, detect_encoding=resource.format == "CSV", file=f)
+    staged.size = resource.content_length = download.size
+    staged.encoding = download.encoding
+    resource.content_hash = download.content_hash
+    if previous is not None and previous.is_unchanged(resource, r, download.content_hash):
+        staged.download_file.unlink()
+        staged.unchanged = True
+    return staged
+
+
+def import_to_staging(staged: StagedResource, record_id: str, task_id: str,
+                      num_res: int) -> tuple[Optional[str], dict[str, TableStatistics]]:
+    """
+    runs in a separate process
+    """
+    stats: dict[str, TableStatistics] = {}
+    logger = RecordLogger(record_id, task_id)
+    db = Database(staged.staging_db)
+    # this file is thrown away after merging, so it doesn't need to survive a crash
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    with Download(staged.download_file.open("rb"), staged.size, staged.encoding) as download:
+        encoding = import_download(db, download, logger, staged.resource, staged.resource_tweaks, staged.i, num_res,
+                                   stats)
+    db.close()
+    return encoding, stats
 
 
-def fetch_dataset(id: str, task_id: str):
-    logger = RecordLogger(id, task_id)
-    logger.set_status("fetching dataset")
-    meta_obj, resources = get_datagv_metadata(id)
-    db_file = ds_dir / f"{id}.db"
-    db = Database(db_file, recreate=True)
-    db.enable_wal()
+def fetch_resources_sequentially(db: Database, to_fetch: list[tuple[int, Resource, ResourceTweaks]],
+                                 tweaks: Tweaks, logger: RecordLogger, num_res: int,
+                                 stats: dict[str, TableStatistics], previous: Optional[PreviousImport],
+                                 imported: list[Resource]) -> None:
+    for i, resource, resource_tweaks in to_fetch:
+        logger.set_status(f"fetching resource {i}/{num_res}")
+        headers = previous.request_headers(resource) if previous is not None else None
+        r = request_resource(resource, tweaks, logger, headers)
+        if previous is not None and previous.is_unchanged(resource, r):
+            r.close()
+            previous.reuse(db, resource, logger, stats)
+            imported.append(resource)
+            continue
+        resource_stats: dict[str, TableStatistics] = {}
+        with download_response(r, logger, detect_encoding=resource.format == "CSV") as download:
+            resource.content_length = download.size
+            resource.content_hash = download.content_hash
+            if previous is not None and previous.is_unchanged(resource, r, download.content_hash):
+                previous.reuse(db, resource, logger, stats)
+                imported.append(resource)
+                continue
+            encoding = import_download(db, download, logger, resource, resource_tweaks, i, num_res, resource_stats)
+        if encoding is None:
+            continue
+        merge_statistics(stats, resource_stats)
+        resource.encoding = encoding
+        resource.tables = list(resource_stats)
+        imported.append(resource)
+
+
+def fetch_resources_concurrently(db: Database, to_fetch: list[tuple[int, Resource, ResourceTweaks]],
+                                 tweaks: Tweaks, logger: RecordLogger, num_res: int,
+                                 stats: dict[str, TableStatistics], previous: Optional[PreviousImport],
+                                 imported: list[Resource]) -> None:
+    """
+    download all resources in parallel (limited per host), import each of them into its own
+    staging database in a process pool and finally merge them into the dataset database in order.
+
+    The pool processes get the cancel event of the supervised import, so that they stop as well when it is cancelled.
+    """
+    with tempfile.TemporaryDirectory(dir=ds_dir, prefix=f".{logger.record_id}-staging-") as staging_dir:
+        staging_dir = Path(staging_dir)
+        staged_resources = [
+            StagedResource(
+                i=i, resource=resource, resource_tweaks=resource_tweaks,
+                download_file=staging_dir / f"{i}.download",
+                staging_db=staging_dir / f"{i}.db",
+            )
+            for i, resource, resource_tweaks in to_fetch
+        ]
+        logger.set_status(f"fetching {len(staged_resources)} resources concurrently")
+        mp_context = multiprocessing.get_context("forkserver")
+        with (ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_THREADS) as download_pool,
+              ProcessPoolExecutor(max_workers=MAX_IMPORT_PROCESSES, mp_context=mp_context,
+                                  initializer=set_cancel_event, initargs=(get_cancel_event(),)) as import_pool):
+            try:
+                merge_staged_resources(db, staged_resources, download_pool, import_pool, tweaks, logger, num_res,
+                                       stats, previous, imported)
+            except BaseException:
+                # don't start any more downloads or imports, the running ones stop at their next log message
+                download_pool.shutdown(wait=False, cancel_futures=True)
+                import_pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+
+def merge_staged_resources(db: Database, staged_resources: list[StagedResource], download_pool: ThreadPoolExecutor,
+                           import_pool: ProcessPoolExecutor, tweaks: Tweaks, logger: RecordLogger, num_res: int,
+                           stats: dict[str, TableStatistics], previous: Optional[PreviousImport],
+                           imported: list[Resource]) -> None:
+    download_futures = [
+        download_pool.submit(download_to_staging, staged, tweaks, logger, previous)
+        for staged in staged_resources
+    ]
+    import_futures: dict[int, Future] = {}
+    for future in as_completed(download_futures):
+        staged = future.result()
+        if staged.unchanged:
+            continue
+        logger.set_status(f"downloaded resource {staged.i}/{num_res}")
+        import_futures[staged.i] = import_pool.submit(
+            import_to_staging, staged, logger.record_id, logger.task_id, num_res
+        )
+
+    for staged in staged_resources:
+        if staged.unchanged:
+            previous.reuse(db, staged.resource, logger, stats)
+            imported.append(staged.resource)
+            continue
+        encoding, staged_stats = import_futures[staged.i].result()
+        if encoding is None:
+            continue
+        logger.set_status(f"merging resource {staged.i}/{num_res}")
+        copy_tables(db, staged.staging_db)
+        merge_statistics(stats, staged_stats)
+        staged.resource.encoding = encoding
+        staged.resource.tables = list(staged_stats)
+        imported.append(staged.resource)
+
 
+def load_tweaks(id: str) -> Tweaks:
     tweaks_file = tweaks_dir / f"{id}.yaml"
     if tweaks_file.exists():
         with tweaks_file.open() as f:
-            tweaks = Tweaks(**yaml.load(f, Loader=yaml.SafeLoader))
-    else:
-        tweaks = Tweaks()
+            return Tweaks(**yaml.load(f, Loader=yaml.SafeLoader))
+    return Tweaks()
 
-    num_res = len(resources)
-    for i, resource in enumerate(resources,start=1):
-        logger.set_status(f"fetching resource {i}/{num_res}")
 
+def remove_database_file(file: Path) -> None:
+    for path in [file, file.with_name(file.name + "-wal"), file.with_name(file.name + "-shm")]:
+        path.unlink(missing_ok=True)
+
+
+def validate_database(file: Path) -> None:
+    conn = sqlite3.connect(file)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise RuntimeError(f"integrity check failed: {result}")
+        num_tables = conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if num_tables == 0:
+            raise RuntimeError("import didn't create any tables")
+    finally:
+        conn.close()
+
+
+def build_dataset(db: Database, id: str, logger: RecordLogger, resources: list[Resource], tweaks: Tweaks,
+                  previous: Optional[PreviousImport], stats: dict[str, TableStatistics],
+                  imported: list[Resource]) -> int:
+    """
+    import all resources into `db`, add indices and optimize it. Returns the size of the database
+    """
+    db.enable_wal()
+
+    num_res = len(resources)
+    to_fetch: list[tuple[int, Resource, ResourceTweaks]] = []
+    for i, resource in enumerate(resources, start=1):
         resource.format = format_normalizer(resource.format)
         format = resource.format
         name = resource.name
@@ -170,51 +537,58 @@ def fetch_dataset(id: str, task_id: str):
             resource_tweaks = ResourceTweaks()
         print("resource tweaks:", resource_tweaks)
 
-        if format not in ["CSV", "XLSX", "XLS", "JSON"]:
+        if format not in ["CSV", "XLSX", "XLS", "ZIP", "JSON", *GEO_FORMATS]:
             logger.set_status(f"skipping {name} ({format})")
             continue
         resource.url = fix_url(resource.url)
+        if format == "WFS":
+            if not is_wfs_get_feature(resource.url):
+                logger.set_status(f"skipping {name} (WFS service without a GetFeature request)")
+                continue
+            resource.url = wfs_geojson_url(resource.url)
         if format == "JSON":
             if "www.parlament.gv.at" not in resource.url:
                 continue
             logger.set_status(f"skipping {name} ({format})")
 
-
         if not allowed_fetch_url(resource.url):
             logger.set_status(f"skipping resource {i}/{num_res} (disallowed server: {resource.url})")
 
         if format == "JSON":
-            encoding = ""
+            logger.set_status(f"fetching resource {i}/{num_res}")
             import_parlament(db, id, logger, name, i, num_res)
+            resource.encoding = ""
+            imported.append(resource)
         else:
-            if "index.php/s/" in resource.url:
-                # nextcloud shared folder
-                r = get_nextcloud_shared_url(resource.url, logger)
-            elif tweaks.custom_user_agent:
-                print(tweaks.custom_user_agent)
-                r = s.get(resource.url, headers={"User-Agent": tweaks.custom_user_agent})
-            else:
-                r = s.get(resource.url)
-            r.raise_for_status()
-            if r.content.startswith(b"PK\x03\x04") and format not in ["XLSX"]:
-                logger.set_status(f"detected ZIP file, skipping resource {i}/{num_res}")
-                continue
-            logger.set_status(f"importing resource {i}/{num_res}")
-            if format == "CSV":
-                encoding = import_csv(db, r, logger, name, resource_tweaks)
-            elif format in ["XLSX", "XLS"]:
-                encoding = format
-                import_xlsx(db, r, logger, name, i, num_res)
-            else:
-                raise RuntimeError(f"unsupported format {format}")
+            resource.import_version = import_version(resource_tweaks)
+            to_fetch.append((i, resource, resource_tweaks))
 
-        meta_db.upsert_resource(resource.id, resource)
+    if CONCURRENT_FETCH and len(to_fetch) > 1:
+        fetch_resources_concurrently(db, to_fetch, tweaks, logger, num_res, stats, previous, imported)
+    else:
+        fetch_resources_sequentially(db, to_fetch, tweaks, logger, num_res, stats, previous, imported)
+
+    for resource in imported:
+        if resource.format in GEO_FORMATS:
+            for table in resource.tables or []:
+                create_spatial_index(db, table, logger)
 
-    logger.set_status(f"adding indices {i}/{num_res}")
+    logger.set_status(f"adding indices")
+    # skip virtual tables like the spatial indices and their shadow tables
+    regular_tables = {row[0] for row in db.execute("SELECT name FROM pragma_table_list WHERE type = 'table'")}
     for tab in db.tables:
+        if tab.name not in regular_tables:
+            continue
+        table_stats = stats.get(tab.name)
         for col in tab.columns:
-            coldet = tab.analyze_column(col.name, most_common=False, least_common=False)
-            if coldet.num_distinct < 50 < coldet.total_rows:
+            col_stats = table_stats.get(col.name) if table_stats is not None else None
+            if col_stats is not None:
+                num_distinct, total_rows = col_stats.num_distinct, col_stats.total_rows
+            else:
+                # tables that were not created by the loader (e.g. parlament data)
+                coldet = tab.analyze_column(col.name, most_common=False, least_common=False)
+                num_distinct, total_rows = coldet.num_distinct, coldet.total_rows
+            if num_distinct < 50 < total_rows:
                 tab.create_index([col.name])
 
         print("tweaks")
@@ -230,28 +604,99 @@ def fetch_dataset(id: str, task_id: str):
             for add_idx in table_tweaks.additional_indices:
                 logger.set_status(f"adding additional indices to {add_idx}")
                 tab.create_index(add_idx)
-        if table_tweaks.fts_indices:
-            for fts_idx in table_tweaks.fts_indices:
-                logger.set_status(f"adding full-text-search to columns {fts_idx}")
-                tab.enable_fts(fts_idx)
 
     # db.index_foreign_keys()
     logger.set_status("optimizing database")
 
+    for table in sorted(regular_tables):
+        table_tweaks = tweaks.tables.get(table, TableTweaks())
+        table_stats = stats.get(table)
+        if table_tweaks.fts_indices:
+            columns = list(dict.fromkeys(column for fts_idx in table_tweaks.fts_indices for column in fts_idx))
+        elif table_tweaks.auto_fts and table_stats is not None:
+            columns = choose_fts_columns(table_stats)
+        else:
+            columns = []
+        if columns:
+            build_fts(db, table, columns, logger, table_tweaks.fts_tokenizer)
+
     db.analyze()
     db.disable_wal()
     db.vacuum()
     # https://til.simonwillison.net/sqlite/database-file-size
     curr = db.execute("select page_size * page_count from pragma_page_count(), pragma_page_size()")
-    db_size = curr.fetchone()[0]
-    db.close()
+    return curr.fetchone()[0]
+
+
+def fetch_dataset(id: str, task_id: str) -> bool:
+    """
+    returns whether the database or its metadata changed, i.e. if Datasette needs to be reloaded
+    """
+    logger = RecordLogger(id, task_id)
+    logger.set_status("fetching dataset")
+    meta_obj, resources = get_datagv_metadata(id)
+    old_record = meta_db.get_record(id)
+    db_file = ds_dir / f"{id}.db"
+    # the new version is built next to the live database, which stays untouched (and queryable)
+    # until it is replaced at the very end
+    shadow_file = ds_dir / f"{id}.db.building"
+    remove_database_file(shadow_file)
+    if db_file.exists():
+        previous = PreviousImport(db_file, meta_db.get_resources(meta_obj), meta_db.get_column_stats(id))
+    else:
+        previous = None
 
-    inspect_data = run_datasette_inspect(f"{id}.db")
+    stats: dict[str, TableStatistics] = {}
+    imported: list[Resource] = []
+    db = Database(shadow_file)
+    try:
+        db_size = build_dataset(db, id, logger, resources, load_tweaks(id), previous, stats, imported)
+        db.close()
+        validate_database(shadow_file)
+    except BaseException:
+        db.close()
+        remove_database_file(shadow_file)
+        logger.set_status("import failed, keeping the previous version")
+        raise
+    os.replace(shadow_file, db_file)
+
+    # only now the resources actually correspond to the live database
+    for resource in imported:
+        meta_db.upsert_resource(resource.id, resource)
+    inspect_data = create_inspect_data(db_file, {table: table_stats.row_count for table, table_stats in stats.items()})
     meta_obj.db_size = db_size
-    meta_obj.compressed_size = zstd_file_size(db_file)
+    meta_obj.compressed_size = compressed_file_size(db_file)
     meta_obj.inspect_data = inspect_data
+    # the exports are only created afterwards
+    changed = old_record is None or (
+            old_record.model_dump(exclude={"num_queries", "export_size"}) !=
+            meta_obj.model_dump(exclude={"num_queries", "export_size"})
+    )
     meta_db.upsert_record(id, meta_obj)
-    logger.set_status("done")
+    meta_db.set_column_stats(id, to_column_stats(id, stats))
+    if CREATE_EXPORTS:
+        logger.set_status("creating exports")
+        try:
+            manifest = create_exports(id, db_file, json.loads(inspect_data)["hash"], logger)
+        except Exception as e:
+            # the new database is already live, so the import must not fail because of its exports
+            traceback.print_exc()
+            logger.set_status(f"creating exports failed: {e!r}")
+            # the ones of the previous version are outdated anyway
+            delete_exports(id)
+        else:
+            meta_db.set_export_size(id, exports_size(manifest))
+    logger.set_status("done" if changed else "done (unchanged)")
+    return changed
+
+
+def cleanup_import(id: str):
+    """
+    remove the files of an import that was killed before it could clean up after itself
+    """
+    remove_database_file(ds_dir / f"{id}.db.building")
+    for staging_dir in ds_dir.glob(f".{id}-staging-*"):
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def delete_dataset(id: str):
@@ -260,17 +705,16 @@ def delete_dataset(id: str):
         dataset_file = ds_dir / f"{id}.db"
         assert dataset_file.exists()
         dataset_file.unlink()
+        remove_database_file(ds_dir / f"{id}.db.building")
+        delete_exports(id)
 
         meta_db.conn.execute("DELETE FROM records WHERE id = ?", (id,))
-        restart_datasette_process()
+    create_ds_metadata()
+    reload_datasette(removed=[id])
 
 
 if __name__ == '__main__':
     id = sys.argv[1]
-    try:
-        delete_dataset(id)
-    except Exception as e:
-        print(e)
-    fetch_dataset(id, "no_task")
-    create_ds_metadata()
-    restart_datasette_process()
+    if fetch_dataset(id, "no_task"):
+        create_ds_metadata()
+        reload_datasette(changed=[id])
@@ -0,0 +1,70 @@
+"""
+full-text search indices that are built in large batches after the import instead of via triggers.
+
+The FTS5 tables are external-content tables, so the text is not stored a second time.
+The naming (`{table}_fts` with `content="table"`) is the one Datasette detects.
+"""
+from typing import Optional
+
+from sqlite_utils import Database
+
+from .geo import GEOMETRY_COLUMN
+from .loader import quote_identifier
+from .progress_logger import RecordLogger
+from .statistics import TableStatistics
+
+# only columns with longer texts are worth searching (e.g. not postal codes or short categories)
+MIN_AVERAGE_LENGTH = 15
+# enum-like columns are indexed normally instead (see the index heuristic in the fetcher)
+MIN_DISTINCT_VALUES = 50
+MAX_FTS_COLUMNS = 8
+FTS_BATCH_SIZE = 100_000
+DEFAULT_TOKENIZER = "unicode61 remove_diacritics 2"
+
+
+def fts_table_name(table: str) -> str:
+    return table + "_fts"
+
+
+def choose_fts_columns(table_stats: TableStatistics) -> list[str]:
+    """
+    pick the columns with the longest free text based on the statistics of the import
+    """
+    candidates = []
+    for column, col_stats in table_stats.columns.items():
+        # GeoJSON geometries are long texts, but only contain coordinates
+        if col_stats.type != "text" or column == GEOMETRY_COLUMN:
+            continue
+        avg_length = col_stats.avg_length
+        if avg_length is None or avg_length < MIN_AVERAGE_LENGTH:
+            continue
+        if col_stats.num_distinct < MIN_DISTINCT_VALUES:
+            continue
+        candidates.append((avg_length, column))
+    candidates.sort(reverse=True)
+    chosen = {column for _, column in candidates[:MAX_FTS_COLUMNS]}
+    # keep the order of the table
+    return [column for column in table_stats.columns if column in chosen]
+
+
+def build_fts(db: Database, table: str, columns: list[str], logger: RecordLogger,
+              tokenizer: Optional[str] = None) -> None:
+    fts_table = fts_table_name(table)
+    logger.set_status(f"adding full-text search for {table} ({', '.join(columns)})")
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+    tokenize = (tokenizer or DEFAULT_TOKENIZER).replace("'", "''")
+    db.execute(f"DROP TABLE IF EXISTS {quote_identifier(fts_table)}")
+    db.execute(
+        f"CREATE VIRTUAL TABLE {quote_identifier(fts_table)} USING FTS5 "
+        f"({column_list}, tokenize='{tokenize}', content={quote_identifier(table)})"
+    )
+    max_rowid = db.execute(f"SELECT max(rowid) FROM {quote_identifier(table)}").fetchone()[0] or 0
+    insert = (
+        f"INSERT INTO {quote_identifier(fts_table)} (rowid, {column_list}) "
+        f"SELECT rowid, {column_list} FROM {quote_identifier(table)} WHERE rowid > ? AND rowid <= ?"
+    )
+    with db.conn:
+        for start in range(0, max_rowid, FTS_BATCH_SIZE):
+            db.execute(insert, [start, start + FTS_BATCH_SIZE])
+        # merge all the b-trees that were created by the batches
+        db.execute(f"INSERT INTO {quote_identifier(fts_table)} ({quote_identifier(fts_table)}) VALUES ('optimize')")
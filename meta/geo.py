@@ -0,0 +1,203 @@
+"""
+import GeoJSON (e.g. from a WFS GetFeature request) with one row per feature
+and add an R*Tree index over the bounding boxes of the geometries.
+
+Datasette can then answer bounding box queries like
+`WHERE rowid IN (SELECT id FROM "rtree_table" WHERE max_x >= :min_x AND min_x <= :max_x AND ...)`
+without scanning the whole table.
+"""
+import json
+import re
+from typing import Any, Optional, Iterator
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+from sqlite_utils import Database
+
+from .download import Download
+from .loader import load_table, quote_identifier, BATCH_SIZE
+from .progress_logger import RecordLogger
+from .statistics import TableStatistics, merge_statistics
+
+GEO_FORMATS = ["GEOJSON", "WFS"]
+GEOMETRY_COLUMN = "geometry"
+READ_SIZE = 1024 * 1024
+# how much is read at most to find the features, e.g. a huge single feature or a non-GeoJSON document is skipped
+MAX_PRESCAN_SIZE = 16 * 1024 * 1024
+
+features_re = re.compile(r'"features"\s*:\s*\[')
+
+BoundingBox = tuple[float, float, float, float]
+
+
+class GeoJSONError(ValueError):
+    pass
+
+
+def is_wfs_get_feature(url: str) -> bool:
+    """
+    only GetFeature requests return data, the URL of the service itself or GetCapabilities return XML
+    """
+    query = {key.lower(): value for key, value in parse_qsl(urlparse(url).query)}
+    return query.get("request", "").lower() == "getfeature"
+
+
+def wfs_geojson_url(url: str) -> str:
+    """
+    ask a WFS server for GeoJSON instead of GML
+    """
+    parts = urlparse(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key.lower() != "outputformat"]
+    query.append(("outputFormat", "json"))
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+def spatial_index_name(table: str) -> str:
+    return "rtree_" + table
+
+
+def property_value(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def bounding_box(geometry: Optional[dict]) -> Optional[BoundingBox]:
+    """
+    returns (min_x, max_x, min_y, max_y) of all coordinates of the geometry
+    """
+    if not geometry:
+        return None
+    if geometry.get("type") == "GeometryCollection":
+        boxes = [b for b in map(bounding_box, geometry.get("geometries", [])) if b is not None]
+        if not boxes:
+            return None
+        return (min(b[0] for b in boxes), max(b[1] for b in boxes),
+                min(b[2] for b in boxes), max(b[3] for b in boxes))
+    xs = []
+    ys = []
+    stack = [geometry.get("coordinates")]
+    while stack:
+        coords = stack.pop()
+        if not coords:
+            continue
+        if isinstance(coords[0], (int, float)):
+            xs.append(coords[0])
+            ys.append(coords[1])
+        else:
+            stack.extend(coords)
+    if not xs:
+        return None
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def parse_document(text: str) -> Iterator[dict]:
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise GeoJSONError(f"not GeoJSON: {e}")
+    if not isinstance(data, dict) or data.get("type") not in ("Feature", "FeatureCollection"):
+        raise GeoJSONError("neither a Feature nor a FeatureCollection")
+    if data["type"] == "Feature":
+        yield data
+    else:
+        yield from data.get("features") or []
+
+
+def iter_features(download: Download) -> Iterator[dict]:
+    """
+    parses the features of a FeatureCollection one by one instead of loading the whole (often huge) file
+    """
+    decoder = json.JSONDecoder()
+    with download.open_text("utf-8-sig") as f:
+        buffer = ""
+        while True:
+            match = features_re.search(buffer)
+            if match is not None:
+                break
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                # e.g. a single feature or an error message
+                yield from parse_document(buffer)
+                return
+            buffer += chunk
+            if len(buffer) > MAX_PRESCAN_SIZE:
+                raise GeoJSONError(f"no features found in the first {MAX_PRESCAN_SIZE} characters")
+
+        buffer = buffer[match.end():]
+        pos = 0
+        while True:
+            # skip the whitespace and commas between the features
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                if buffer[pos] == "]":
+                    return
+                try:
+                    feature, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # the feature continues in the next chunk (or the file is broken)
+                    pass
+                else:
+                    if not isinstance(feature, dict):
+                        raise GeoJSONError("features must be objects")
+                    yield feature
+                    continue
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                raise GeoJSONError("incomplete or invalid GeoJSON")
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def import_geojson(db: Database, download: Download, logger: RecordLogger, name: str,
+                   stats: dict[str, TableStatistics]) -> None:
+    """
+    the properties of the features become columns, the geometry is stored as GeoJSON text.
+    Raises `GeoJSONError` before anything is imported if the file can't be parsed.
+    """
+    logger.set_status(f"reading GeoJSON")
+    property_names = {}
+    num_features = 0
+    for feature in iter_features(download):
+        num_features += 1
+        for key in (feature.get("properties") or {}):
+            property_names.setdefault(key, None)
+    properties = [key for key in property_names if key != GEOMETRY_COLUMN]
+    header = properties + [GEOMETRY_COLUMN]
+
+    def rows() -> Iterator[list[Any]]:
+        for feature in iter_features(download):
+            feature_properties = feature.get("properties") or {}
+            geometry = feature.get("geometry")
+            yield [property_value(feature_properties.get(key)) for key in properties] + [
+                json.dumps(geometry) if geometry is not None else None
+            ]
+
+    logger.set_status(f"importing {num_features} features")
+    merge_statistics(stats, {name: load_table(db, name, header, rows, logger)})
+
+
+def create_spatial_index(db: Database, table: str, logger: RecordLogger) -> None:
+    index = spatial_index_name(table)
+    logger.set_status(f"adding spatial index {index}")
+    db.execute(f"DROP TABLE IF EXISTS {quote_identifier(index)}")
+    db.execute(f"CREATE VIRTUAL TABLE {quote_identifier(index)} USING rtree(id, min_x, max_x, min_y, max_y)")
+    insert = f"INSERT INTO {quote_identifier(index)} VALUES (?, ?, ?, ?, ?)"
+    cursor = db.execute(
+        f"SELECT rowid, {quote_identifier(GEOMETRY_COLUMN)} FROM {quote_identifier(table)} "
+        f"WHERE {quote_identifier(GEOMETRY_COLUMN)} IS NOT NULL"
+    )
+    with db.conn:
+        while True:
+            batch = cursor.fetchmany(BATCH_SIZE)
+            if not batch:
+                break
+            boxes = []
+            for rowid, geometry in batch:
+                try:
+                    box = bounding_box(json.loads(geometry))
+                except (ValueError, TypeError, IndexError, AttributeError):
+                    box = None
+                if box is not None:
+                    boxes.append((rowid, *box))
+            db.conn.executemany(insert, boxes)
@@ -4,6 +4,7 @@ a few global objects I need everywhere and will therefore define here for now
 from datetime import timedelta
 from pathlib import Path
 
+import requests
 import requests_cache
 
 root_dir = Path(__file__).parent.parent
@@ -11,3 +12,6 @@ tweaks_dir = root_dir / "tweaks"
 ds_dir = root_dir / "ds"
 s = requests_cache.CachedSession(ds_dir / 'requests_cache', expire_after=timedelta(hours=1),allowable_methods=('GET', 'POST'))
 s.cache.delete(expired=True)
+
+# resource downloads are streamed to disk and therefore bypass the (in-memory) cache
+download_session = requests.Session()
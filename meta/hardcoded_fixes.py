@@ -3,7 +3,10 @@ def fix_url(url: str) -> str:
 
 
 formats = {
-    "CSV": [".csv", "csv-datei"]
+    "CSV": [".csv", "csv-datei"],
+    "ZIP": [".zip", "zip"],
+    "GEOJSON": ["geojson", "GeoJSON"],
+    "WFS": ["wfs", "WFS-Dienst"],
 }
 format_mapping = {}
 for correct_format, wrong_formats in formats.items():
@@ -0,0 +1,55 @@
+"""
+create the same data as `datasette inspect` without starting a datasette process
+"""
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+from .loader import quote_identifier
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(file: Path) -> str:
+    m = hashlib.sha256()
+    with file.open("rb") as f:
+        while True:
+            data = f.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+def table_counts(file: Path, known_counts: Optional[dict[str, int]] = None) -> dict[str, int]:
+    """
+    only tables whose row count is not known from the import are counted
+    """
+    known_counts = known_counts or {}
+    counts = {}
+    conn = sqlite3.connect(file.resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        table_names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in table_names:
+            if table in known_counts:
+                counts[table] = known_counts[table]
+            else:
+                counts[table] = conn.execute(f"SELECT count(*) FROM {quote_identifier(table)}").fetchone()[0]
+    finally:
+        conn.close()
+    return counts
+
+
+def create_inspect_data(file: Path, known_counts: Optional[dict[str, int]] = None) -> str:
+    data = {
+        "hash": file_hash(file),
+        "size": file.stat().st_size,
+        "file": file.name,
+        "tables": {
+            table: {"count": count}
+            for table, count in table_counts(file, known_counts).items()
+        },
+    }
+    return json.dumps(data)
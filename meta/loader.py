@@ -0,0 +1,319 @@
+"""
+load tabular data into SQLite in two passes:
+the first pass over the (spooled) file only guesses the column types,
+the second one creates the table with the final types and bulk-inserts all rows.
+
+This avoids inserting everything as TEXT and copying the whole table again with `transform()`.
+"""
+import re
+from pathlib import Path
+from typing import Iterable, Sequence, Callable, Any, Optional
+
+import pandas as pd
+from sqlite_utils import Database
+
+from .progress_logger import RecordLogger
+from .statistics import TableStatistics
+
+# increase when a change to the import changes the resulting tables, so that
+# unchanged resources are imported again instead of copied from the previous import
+LOADER_VERSION = 3
+BATCH_SIZE = 10_000
+TRANSACTION_SIZE = 500_000
+
+SQL_TYPES = {
+    "integer": "INTEGER",
+    "float": "REAL",
+    "decimal_comma": "REAL",
+    "text": "TEXT",
+}
+
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+# Austrian/German style numbers like "1.234.567,89", "-12,5" or "1234"
+decimal_comma_re = re.compile(r"^\s*[+-]?(\d{1,3}(\.\d{3})+|\d+)(,\d+)?\s*$")
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def is_empty(value: Any) -> bool:
+    return value is None or value == ""
+
+
+def fits_integer(value: int) -> bool:
+    # larger values (e.g. long account numbers) can't be stored as SQLite INTEGER
+    return MIN_INTEGER <= value <= MAX_INTEGER
+
+
+def could_be_integer(value: Any) -> bool:
+    if isinstance(value, int):
+        return fits_integer(value)
+    if isinstance(value, float):
+        return value.is_integer() and fits_integer(int(value))
+    if isinstance(value, str):
+        # Python accepts "1_000", but that's not how numbers are written in the data
+        if "_" in value:
+            return False
+        try:
+            return fits_integer(int(value))
+        except ValueError:
+            return False
+    return False
+
+
+def could_be_float(value: Any) -> bool:
+    if isinstance(value, (int, float)):
+        return True
+    if isinstance(value, str):
+        if "_" in value:
+            return False
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+def could_be_decimal_comma(value: Any) -> bool:
+    return isinstance(value, str) and decimal_comma_re.match(value) is not None
+
+
+class ColumnTypeGuesser:
+    """
+    same idea as sqlite_utils' ValueTracker, but for a single column without the dict overhead.
+
+    A column is only treated as containing decimal commas if every value looks like such a number
+    and at least one value actually contains a comma. Otherwise, text with commas is kept as it is.
+    """
+
+    def __init__(self):
+        self.integer = True
+        self.float = True
+        self.decimal_comma = True
+        self.has_comma = False
+
+    def evaluate(self, value: Any) -> None:
+        if is_empty(value):
+            return
+        if self.integer and not could_be_integer(value):
+            self.integer = False
+        if self.float and not self.integer and not could_be_float(value):
+            self.float = False
+        if self.decimal_comma:
+            if not could_be_decimal_comma(value):
+                self.decimal_comma = False
+            elif not self.has_comma and "," in value:
+                self.has_comma = True
+
+    @property
+    def type(self) -> str:
+        if self.integer:
+            return "integer"
+        if self.float:
+            return "float"
+        if self.decimal_comma and self.has_comma:
+            return "decimal_comma"
+        return "text"
+
+
+def unique_column_names(header: Sequence[Any]) -> list[str]:
+    columns = []
+    seen = set()
+    for i, name in enumerate(header, start=1):
+        name = str(name).strip() if name is not None else ""
+        if not name:
+            name = f"column_{i}"
+        candidate = name
+        suffix = 2
+        while candidate.lower() in seen:
+            candidate = f"{name}_{suffix}"
+            suffix += 1
+        seen.add(candidate.lower())
+        columns.append(candidate)
+    return columns
+
+
+def fit_row(row: Sequence[Any], num_columns: int) -> Sequence[Any]:
+    if len(row) == num_columns:
+        return row
+    if len(row) > num_columns:
+        return row[:num_columns]
+    return list(row) + [None] * (num_columns - len(row))
+
+
+def row_width(row: Sequence[Any]) -> int:
+    # trailing empty cells (e.g. formatted but empty cells in Excel) don't count
+    width = len(row)
+    while width and is_empty(row[width - 1]):
+        width -= 1
+    return width
+
+
+def guess_column_types(rows: Iterable[Sequence[Any]], num_columns: int) -> list[str]:
+    """
+    returns more than `num_columns` types if some rows are wider than the header
+    (e.g. if the first row of a sheet is a title instead of the header)
+    """
+    guessers = [ColumnTypeGuesser() for _ in range(num_columns)]
+    for row in rows:
+        if len(row) > len(guessers):
+            guessers.extend(ColumnTypeGuesser() for _ in range(row_width(row) - len(guessers)))
+        for guesser, value in zip(guessers, row):
+            guesser.evaluate(value)
+    return [g.type for g in guessers]
+
+
+def convert_integer(value: Any) -> Optional[int]:
+    if is_empty(value):
+        return None
+    return int(value)
+
+
+def convert_float(value: Any) -> Optional[float]:
+    if is_empty(value):
+        return None
+    return float(value)
+
+
+def convert_text(value: Any) -> Any:
+    if value is None or isinstance(value, (str, bytes)):
+        return value
+    return str(value)
+
+
+def map_converter(converter: Callable[[Any], Any]) -> Callable[[Sequence[Any]], list]:
+    def convert_column(values: Sequence[Any]) -> list:
+        return list(map(converter, values))
+
+    return convert_column
+
+
+def convert_decimal_comma_column(values: Sequence[Any]) -> list:
+    """
+    convert a whole column of a batch at once: "1.234,5" -> 1234.5
+    """
+    strings = pd.Series(values, dtype="string")
+    strings = strings.str.strip().str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    numbers = pd.to_numeric(strings, errors="coerce").astype(object)
+    return numbers.where(numbers.notna(), None).tolist()
+
+
+column_converters: dict[str, Callable[[Sequence[Any]], list]] = {
+    "integer": map_converter(convert_integer),
+    "float": map_converter(convert_float),
+    "decimal_comma": convert_decimal_comma_column,
+    "text": map_converter(convert_text),
+}
+
+
+def create_table(db: Database, name: str, columns: list[str], types: list[str]) -> None:
+    column_defs = ", ".join(f"{quote_identifier(c)} {SQL_TYPES[t]}" for c, t in zip(columns, types))
+    # an existing table (e.g. from a resource with the same name) is appended to
+    db.execute(f"CREATE TABLE IF NOT EXISTS {quote_identifier(name)} ({column_defs})")
+
+
+def convert_batch(batch: list[Sequence[Any]], converters: list[Callable[[Sequence[Any]], list]]) -> list[list]:
+    """
+    convert the batch column by column, so that numeric columns can be handled in one go
+    """
+    columns = zip(*batch)
+    return [conv(column) for conv, column in zip(converters, columns)]
+
+
+def bulk_insert(db: Database, name: str, columns: list[str], types: list[str],
+                rows: Iterable[Sequence[Any]], logger: RecordLogger) -> TableStatistics:
+    """
+    insert all rows and collect statistics about every column while doing so
+    """
+    num_columns = len(columns)
+    converters = [column_converters[t] for t in types]
+    stats = TableStatistics(columns, types)
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote_identifier(name),
+        ", ".join(quote_identifier(c) for c in columns),
+        ", ".join("?" for _ in columns)
+    )
+
+    conn = db.conn
+    in_transaction = 0
+    batch = []
+
+    def insert_batch():
+        converted = convert_batch(batch, converters)
+        stats.update(converted)
+        # the first statement implicitly opens a transaction that is only committed every few batches
+        conn.executemany(sql, zip(*converted))
+
+    try:
+        for row in rows:
+            batch.append(fit_row(row, num_columns))
+            if len(batch) >= BATCH_SIZE:
+                insert_batch()
+                in_transaction += len(batch)
+                batch = []
+                if in_transaction >= TRANSACTION_SIZE:
+                    conn.commit()
+                    in_transaction = 0
+                    logger.set_status(f"inserted {stats.row_count} rows into {name}")
+        if batch:
+            insert_batch()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return stats
+
+
+def load_table(db: Database, name: str, header: Sequence[Any],
+               rows: Callable[[], Iterable[Sequence[Any]]], logger: RecordLogger) -> TableStatistics:
+    """
+    `rows` needs to return a fresh iterator over all rows (without the header) every time it is called
+    as the data is read twice.
+    """
+    logger.set_status(f"detecting types")
+    types = guess_column_types(rows(), len(header))
+    # the extra columns of rows wider than the header are named column_N instead of being dropped
+    columns = unique_column_names(list(header) + [None] * (len(types) - len(header)))
+    logger.set_status(f"detected types: {dict(zip(columns, types))}")
+
+    create_table(db, name, columns, types)
+    logger.set_status(f"inserting rows into {name}")
+    stats = bulk_insert(db, name, columns, types, rows(), logger)
+    logger.set_status(f"inserted {stats.row_count} rows into {name}")
+    return stats
+
+
+def copy_tables(db: Database, source_file: Path, tables: Optional[list[str]] = None) -> list[str]:
+    """
+    copy tables (by default all of them) from another SQLite file into `db`
+    using ATTACH and INSERT ... SELECT, so that no rows pass through Python
+    """
+    db.execute("ATTACH DATABASE ? AS source", [str(source_file)])
+    try:
+        source_tables = db.execute(
+            "SELECT name, sql FROM source.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+        copied = []
+        with db.conn:
+            for name, sql in source_tables:
+                if tables is not None and name not in tables:
+                    continue
+                if not db[name].exists():
+                    # the CREATE TABLE statement without a schema name creates the table in main
+                    db.execute(sql)
+                columns = ", ".join(
+                    quote_identifier(row[1]) for row in
+                    db.execute(f"PRAGMA source.table_info({quote_identifier(name)})").fetchall()
+                )
+                db.execute(
+                    f"INSERT INTO main.{quote_identifier(name)} ({columns}) "
+                    f"SELECT {columns} FROM source.{quote_identifier(name)}"
+                )
+                copied.append(name)
+    finally:
+        db.execute("DETACH DATABASE source")
+    return copied
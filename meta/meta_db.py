@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from sqlite_utils import Database
 
 from very_simple_task_queue import Job
+from very_simple_task_queue.notify import Notifier
 from .globals import root_dir
 from .utils import Url
 
@@ -32,6 +33,8 @@ class Record(BaseModel):
 
     db_size: Optional[int] = None
     compressed_size: Optional[int] = None
+    # of the Parquet and CSV exports (see exports.py), set after they were created
+    export_size: Optional[int] = None
     num_queries: Optional[int] = 0
 
     @property
@@ -53,37 +56,132 @@ class Resource(BaseModel):
     position: Optional[int] = None
     encoding: Optional[str] = None
     last_fetched: datetime
+    # used to skip unchanged resources on the next fetch
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_length: Optional[int] = None
+    content_hash: Optional[str] = None
+    # the tweaks and loader version the tables were created with
+    import_version: Optional[str] = None
+    tables: Optional[list[str]] = None
+
+
+class RecordView:
+    """
+    a (possibly partial) row of the records table together with the resources of the record.
+
+    Unlike `Record`, nothing is validated and the JSON columns are only decoded when they are accessed,
+    so listing many records is cheap.
+    """
+    json_columns = {"tags", "api_data"}
+
+    def __init__(self, row: dict, resources: Optional[list[Resource]] = None):
+        self._row = row
+        self._decoded = {}
+        self.resources = resources if resources is not None else []
+
+    def __getattr__(self, name: str):
+        try:
+            value = self._row[name]
+        except KeyError:
+            raise AttributeError(f"{name} was not loaded") from None
+        if name in self.json_columns and value is not None:
+            if name not in self._decoded:
+                self._decoded[name] = json.loads(value)
+            return self._decoded[name]
+        return value
+
+    @property
+    def datagvurl(self):
+        return "https://www.data.gv.at/katalog/dataset/" + self.id
+
+    @property
+    def datasetteurl(self):
+        return "/" + self.id
+
+    def to_record(self) -> Record:
+        return Record(**{column: getattr(self, column) for column in self._row})
+
+
+class ColumnStats(BaseModel):
+    record: str
+    table_name: str
+    column_name: str
+    type: str
+    total_rows: int
+    null_count: int
+    num_distinct: int
+    min: Optional[str] = None
+    max: Optional[str] = None
+    avg_length: Optional[float] = None
+
+
+RECORDS_SEARCH_COLUMNS = ["title", "notes", "publisher", "tags"]
+RECORDS_LIST_COLUMNS = ["id", "title", "publisher", "num_queries", "db_size", "metadata_modified"]
+RECORDS_SORT_ORDERS = {
+    "title": "records.title COLLATE NOCASE",
+    "queries": "records.num_queries DESC",
+    "size": "records.db_size DESC",
+    "modified": "records.metadata_modified DESC",
+    "relevance": "records_fts.rank",
+}
 
 
 class MetaDatabase:
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, read_only: bool = False):
         self.db = db
         self.conn: Connection = db.conn
         self.records = self.db["records"]
         self.resources = self.db["resources"]
         self.status = self.db["status"]
+        self.column_stats = self.db["column_stats"]
+        self.compressed_sizes = self.db["compressed_sizes"]
+        self.metadata_fragments = self.db["metadata_fragments"]
+        if read_only:
+            # the connections of the web server (see async_db.py) rely on the writer having set things up
+            return
         self.db.enable_wal()
+        if self.records.exists() and "export_size" not in self.records.columns_dict:
+            self.records.add_column("export_size", int)
+        self.ensure_records_search()
+
+    def ensure_records_search(self) -> None:
+        """
+        full-text search over the catalog for the home page, kept up to date by triggers
+        """
+        if not self.records.exists() or self.db["records_fts"].exists():
+            return
+        self.records.enable_fts(RECORDS_SEARCH_COLUMNS, create_triggers=True, tokenize="unicode61 remove_diacritics 2")
 
     def upsert_record(self, id: str, data: Record):
         assert id == data.id
         as_dict = Record.model_dump(data)
-        return self.records.upsert(as_dict, pk="id", defaults={"num_queries": 0})
+        result = self.records.upsert(as_dict, pk="id", defaults={"num_queries": 0})
+        # the records table is only created by the first upsert
+        self.ensure_records_search()
+        return result
 
     def upsert_resource(self, id, data: Resource):
         assert id == data.id
         as_dict = Resource.model_dump(data)
-        as_dict["record"] = data.record.id
-        return self.resources.upsert(as_dict, pk="id", foreign_keys=["record"])
+        if not isinstance(data.record, str):
+            as_dict["record"] = data.record.id
+        return self.resources.upsert(as_dict, pk="id", foreign_keys=["record"], alter=True)
+
+    def res_row_to_resource(self, row: dict) -> Resource:
+        if row.get("tables") is not None:
+            row["tables"] = json.loads(row["tables"])
+        return Resource(**row)
 
     def get_resources(self, record: Record) -> list[Resource]:
-        return [Resource(**row) for row in self.db.query("SELECT * FROM resources where record= ?", [record.id])]
+        return [self.res_row_to_resource(row) for row in self.db.query("SELECT * FROM resources where record= ?", [record.id])]
 
     def get_resource(self, id) -> Optional[Resource]:
         try:
             row = list(self.db.query("SELECT * FROM resources where id= ?", [id]))[0]
         except IndexError:
             return None
-        return Resource(**row)
+        return self.res_row_to_resource(row)
 
     def get_record(self, id) -> Optional[Record]:
         try:
@@ -100,20 +198,160 @@ class MetaDatabase:
     def get_records(self) -> list[Record]:
         return [self.self_rec_row_to_record(row) for row in self.records.rows]
 
-    def total_storage(self) -> tuple[int, int]:  #
-        return (
-            self.conn.execute("SELECT SUM(db_size) FROM records").fetchone()[0],
-            self.conn.execute("SELECT SUM(compressed_size) FROM records").fetchone()[0]
+    def get_record_views(self, ids: Optional[list[str]] = None, columns: Optional[list[str]] = None,
+                         with_resources: bool = True) -> list[RecordView]:
+        """
+        loads the records (optionally only `ids` and only some `columns`) and their resources
+        with two queries in total instead of one per record
+        """
+        if columns is None:
+            projection = "*"
+        else:
+            columns = list(dict.fromkeys(["id", *columns]))
+            unknown = set(columns) - set(self.records.columns_dict)
+            if unknown:
+                raise ValueError(f"unknown columns {unknown}")
+            projection = ", ".join(f'"{c}"' for c in columns)
+        sql = f"SELECT {projection} FROM records"
+        params = []
+        if ids is not None:
+            sql += " WHERE id IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(ids))
+        views = [RecordView(row) for row in self.db.query(sql + " ORDER BY rowid", params)]
+        if not with_resources or not views:
+            return views
+
+        by_id = {view.id: view for view in views}
+        resource_rows = self.db.query(
+            "SELECT * FROM resources WHERE record IN (SELECT value FROM json_each(?)) ORDER BY rowid",
+            [json.dumps(list(by_id))]
+        )
+        for row in resource_rows:
+            by_id[row["record"]].resources.append(self.res_row_to_resource(row))
+        return views
+
+    def list_records(self, page: int = 1, per_page: int = 50, sort: str = "title",
+                     search: Optional[str] = None) -> tuple[list[RecordView], int]:
+        """
+        one page of the catalog (only the columns needed for listing it) and the total number of matching records
+        """
+        if not self.records.exists():
+            return [], 0
+        columns = ", ".join(f"records.{c}" for c in RECORDS_LIST_COLUMNS)
+        if search:
+            source = "records_fts JOIN records ON records.rowid = records_fts.rowid WHERE records_fts MATCH :search"
+            # every word is also matched as a prefix, so that e.g. "grill" finds "Grillplätze"
+            params = {"search": " ".join('"' + word.replace('"', '""') + '"*' for word in search.split())}
+        else:
+            source = "records"
+            params = {}
+        if sort not in RECORDS_SORT_ORDERS or (sort == "relevance" and not search):
+            sort = "title"
+        total = self.conn.execute(f"SELECT count(*) FROM {source}", params).fetchone()[0]
+        rows = self.db.query(
+            f"SELECT {columns} FROM {source} ORDER BY {RECORDS_SORT_ORDERS[sort]}, records.id LIMIT :limit OFFSET :offset",
+            {**params, "limit": per_page, "offset": (max(page, 1) - 1) * per_page}
+        )
+        return [RecordView(row) for row in rows], total
+
+    def get_record_versions(self) -> list[tuple[str, str, Optional[int], Optional[int], Optional[str]]]:
+        """
+        (id, metadata_modified, db_size, compressed_size, database hash) of all records,
+        without loading the whole records
+        """
+        return self.conn.execute(
+            "SELECT id, metadata_modified, db_size, compressed_size, json_extract(inspect_data, '$.hash') "
+            "FROM records ORDER BY rowid"
+        ).fetchall()
+
+    def get_metadata_fragment_keys(self) -> dict[str, str]:
+        if not self.metadata_fragments.exists():
+            return {}
+        return dict(self.conn.execute("SELECT record, cache_key FROM metadata_fragments"))
+
+    def set_metadata_fragment(self, record_id: str, cache_key: str, metadata: str, queries: Optional[str],
+                              inspect_data: Optional[str]) -> None:
+        self.metadata_fragments.upsert({
+            "record": record_id,
+            "cache_key": cache_key,
+            "metadata": metadata,
+            "queries": queries,
+            "inspect_data": inspect_data,
+        }, pk="record")
+
+    def delete_metadata_fragments(self, keep: set[str]) -> None:
+        for record_id in set(self.get_metadata_fragment_keys()) - keep:
+            self.metadata_fragments.delete(record_id)
+
+    def get_metadata_fragments(self, record_ids: list[str]) -> list[tuple[str, str, Optional[str], Optional[str]]]:
+        """
+        (record id, metadata, queries, inspect data) in the order of `record_ids`
+        """
+        fragments = {
+            row[0]: row for row in
+            self.conn.execute("SELECT record, metadata, queries, inspect_data FROM metadata_fragments")
+        }
+        return [fragments[record_id] for record_id in record_ids if record_id in fragments]
+
+    def set_column_stats(self, record_id: str, stats: list[ColumnStats]) -> None:
+        self.column_stats.delete_where("record = ?", [record_id])
+        self.column_stats.insert_all(
+            [ColumnStats.model_dump(s) for s in stats],
+            pk=("record", "table_name", "column_name"),
+            foreign_keys=[("record", "records", "id")],
+            alter=True,
         )
 
-    def get_tasks_for_record(self, record: Record) -> list[Job]:
+    def get_column_stats(self, record_id: str) -> list[ColumnStats]:
+        if not self.column_stats.exists():
+            return []
+        return [ColumnStats(**row) for row in self.db.query("SELECT * FROM column_stats WHERE record = ?", [record_id])]
+
+    def get_cached_compressed_size(self, path: str, size: int, mtime_ns: int, allow_sampled: bool) -> Optional[int]:
+        if not self.compressed_sizes.exists():
+            return None
+        row = self.conn.execute(
+            "SELECT compressed_size FROM compressed_sizes WHERE path = ? AND size = ? AND mtime_ns = ? AND sampled <= ?",
+            [path, size, mtime_ns, allow_sampled]
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_cached_compressed_size(self, path: str, size: int, mtime_ns: int, compressed_size: int,
+                                   sampled: bool) -> None:
+        self.compressed_sizes.upsert({
+            "path": path,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "compressed_size": compressed_size,
+            "sampled": sampled,
+        }, pk="path")
+
+    def set_export_size(self, id: str, export_size: Optional[int]) -> None:
+        with self.conn:
+            self.conn.execute("UPDATE records SET export_size = ? WHERE id = ?", [export_size, id])
+
+    def total_storage(self) -> tuple[int, int, int]:
+        """
+        the sums of the database sizes, their compressed sizes and the sizes of the exports
+        """
+        return self.conn.execute(
+            "SELECT SUM(db_size), SUM(compressed_size), SUM(export_size) FROM records"
+        ).fetchone()
+
+    def get_tasks_for_record(self, record: Record | RecordView) -> list[Job]:
         conn = self.conn.execute("SELECT job_id,status,data,in_time FROM queue WHERE record= :record_id ORDER BY in_time DESC",
                                  {"record_id": record.id})
 
         return [Job(job_id, status, record.id, json.loads(data), in_time) for job_id, status, data, in_time in conn]
 
 
-meta_sqlite_conn = Connection(root_dir / "ds/meta_db.db")
+meta_db_file = root_dir / "ds/meta_db.db"
+
+# resources are downloaded in multiple threads that all log their progress
+meta_sqlite_conn = Connection(meta_db_file, check_same_thread=False)
+# wakes up everyone following the progress of a task (the task id is the topic)
+# when a status is logged or the job state changes
+status_notifier = Notifier(meta_db_file.with_name(meta_db_file.name + "-status-notify"))
 
 # have just one singleton object
 meta_db = MetaDatabase(Database(meta_sqlite_conn))
@@ -1,13 +1,47 @@
+import sqlite3
+import threading
 from datetime import datetime
+from typing import Optional
 
-from .meta_db import meta_db
+from sqlite_utils import Database
+
+from .meta_db import meta_db, status_notifier, MetaDatabase, meta_db_file
+
+# set in supervised import processes (see supervisor.py)
+cancel_event = None
+
+
+thread_local = threading.local()
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+def log_db() -> Database:
+    """
+    resources are downloaded in multiple threads that all log their progress, every thread uses its own
+    connection, so that their implicit transactions don't interleave on the shared one
+    """
+    if not hasattr(thread_local, "db"):
+        thread_local.db = Database(sqlite3.connect(meta_db_file, timeout=30))
+    return thread_local.db
+
+
+def set_cancel_event(event) -> None:
+    global cancel_event
+    cancel_event = event
+
+
+def get_cancel_event():
+    # e.g. to hand it on to a process pool
+    return cancel_event
 
 
 class RecordLogger:
     def __init__(self, record_id: str, task_id: str = None):
         self.record_id = record_id
         self.task_id = task_id
-        self.log = meta_db.db["logging"]
         meta_db.db["logging"].create({
             "record_id": str,
             "task_id": str,
@@ -20,33 +54,38 @@ class RecordLogger:
         meta_db.db["logging"].create_index(["task_id"], if_not_exists=True)
 
     def set_status(self, status: str):
+        # the import checks regularly whether it should stop by logging its progress
+        if cancel_event is not None and cancel_event.is_set():
+            raise ImportCancelled(f"cancelled while: {status}")
         print("logger:", status)
-        self.log.insert({
+        log_db()["logging"].insert({
             "record_id": self.record_id,
             "task_id": self.task_id,
             "status": status,
             "timestamp": datetime.now(),
         })
+        if self.task_id is not None:
+            status_notifier.notify(self.task_id)
 
     @staticmethod
-    def get_latest_status_by_task_id(task_id):
-        curr = meta_db.db.execute(
+    def get_latest_status_by_task_id(task_id, db: Optional[MetaDatabase] = None):
+        curr = (db or meta_db).db.execute(
             "SELECT status FROM logging where task_id = ? ORDER BY timestamp DESC LIMIT 1;",
             [task_id]
         )
         return curr.fetchone()[0]
 
     @staticmethod
-    def get_all_status_by_record_id(record_id):
-        curr = meta_db.db.execute(
+    def get_all_status_by_record_id(record_id, db: Optional[MetaDatabase] = None):
+        curr = (db or meta_db).db.execute(
             "SELECT timestamp,status FROM logging where record_id = ? ORDER BY timestamp DESC",
             [record_id]
         )
         return curr.fetchall()
 
     @staticmethod
-    def get_all_status_by_task_id(task_id):
-        curr = meta_db.db.execute(
+    def get_all_status_by_task_id(task_id, db: Optional[MetaDatabase] = None):
+        curr = (db or meta_db).db.execute(
             "SELECT timestamp,status FROM logging where task_id = ? ORDER BY timestamp",
             [task_id]
         )
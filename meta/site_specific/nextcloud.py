@@ -33,7 +33,7 @@ def get_nextcloud_shared_url(url: str, logger: RecordLogger):
 
     logger.set_status(f"fetching {href} from NextCloud shared URL")
 
-    r = requests.get(nextcloud_base_url + href, auth=(share_id, ""))
+    r = requests.get(nextcloud_base_url + href, auth=(share_id, ""), stream=True)
     return r
 
 if __name__ == '__main__':
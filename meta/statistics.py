@@ -0,0 +1,186 @@
+"""
+per-column statistics that are collected while the rows are inserted,
+so that no additional full-table scans are needed afterwards (e.g. to decide which columns to index)
+"""
+import math
+from typing import Any, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .meta_db import ColumnStats
+
+
+class HyperLogLog:
+    """
+    estimates the number of distinct values with a fixed amount of memory (2^precision bytes)
+
+    pandas' hash_array is used as it is stable across processes,
+    so that statistics collected in different import processes can be merged
+    """
+
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = np.zeros(self.num_registers, dtype=np.uint8)
+
+    def add(self, values: np.ndarray) -> None:
+        if len(values) == 0:
+            return
+        hashes = pd.util.hash_array(values)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        # the remaining bits, with a sentinel bit so that the rank is bounded
+        remaining = (hashes << np.uint64(self.precision)) | np.uint64(1 << (self.precision - 1))
+        _, bit_length = np.frexp(remaining.astype(np.float64))
+        rank = (65 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        assert self.precision == other.precision
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> int:
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is far more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class ColumnStatistics:
+    def __init__(self, type: str):
+        self.type = type
+        self.total_rows = 0
+        self.null_count = 0
+        self.distinct = HyperLogLog()
+        self.min: Any = None
+        self.max: Any = None
+        # distinct values of rows that were not seen directly (e.g. statistics loaded from the meta DB)
+        self.known_distinct = 0
+        # summed up length of all text values
+        self.total_length = 0
+
+    def update(self, values: Sequence[Any]) -> None:
+        values = np.asarray(values, dtype=object)
+        not_null = values[pd.notna(values)]
+        self.total_rows += len(values)
+        self.null_count += len(values) - len(not_null)
+        if len(not_null) == 0:
+            return
+        self.distinct.add(not_null)
+        if self.type == "text":
+            self.total_length += int(pd.Series(not_null, dtype=object).str.len().sum())
+        try:
+            self.update_range(not_null.min(), not_null.max())
+        except TypeError:
+            # values of different types that can't be compared
+            pass
+
+    def update_range(self, min_value: Any, max_value: Any) -> None:
+        if min_value is not None and (self.min is None or min_value < self.min):
+            self.min = min_value
+        if max_value is not None and (self.max is None or max_value > self.max):
+            self.max = max_value
+
+    def merge(self, other: "ColumnStatistics") -> None:
+        self.total_rows += other.total_rows
+        self.null_count += other.null_count
+        self.distinct.merge(other.distinct)
+        self.known_distinct += other.known_distinct
+        self.total_length += other.total_length
+        self.update_range(other.min, other.max)
+
+    @property
+    def num_distinct(self) -> int:
+        # when merging with stored statistics this is only an upper bound
+        return self.distinct.count() + self.known_distinct
+
+    @property
+    def avg_length(self) -> Optional[float]:
+        num_values = self.total_rows - self.null_count
+        if self.type != "text" or num_values == 0:
+            return None
+        return self.total_length / num_values
+
+
+class TableStatistics:
+    def __init__(self, columns: Sequence[str], types: Sequence[str]):
+        self.row_count = 0
+        self.columns = {column: ColumnStatistics(type) for column, type in zip(columns, types)}
+
+    def update(self, columns: Sequence[Sequence[Any]]) -> None:
+        for stats, values in zip(self.columns.values(), columns):
+            stats.update(values)
+        if columns:
+            self.row_count += len(columns[0])
+
+    def merge(self, other: "TableStatistics") -> None:
+        self.row_count += other.row_count
+        for column, stats in other.columns.items():
+            if column in self.columns:
+                self.columns[column].merge(stats)
+            else:
+                self.columns[column] = stats
+
+    def get(self, column: str) -> Optional[ColumnStatistics]:
+        return self.columns.get(column)
+
+
+def merge_statistics(target: dict[str, TableStatistics], source: dict[str, TableStatistics]) -> None:
+    for table, stats in source.items():
+        if table in target:
+            target[table].merge(stats)
+        else:
+            target[table] = stats
+
+
+def to_column_stats(record_id: str, stats: dict[str, TableStatistics]) -> list[ColumnStats]:
+    return [
+        ColumnStats(
+            record=record_id,
+            table_name=table,
+            column_name=column,
+            type=col_stats.type,
+            total_rows=col_stats.total_rows,
+            null_count=col_stats.null_count,
+            num_distinct=col_stats.num_distinct,
+            min=str(col_stats.min) if col_stats.min is not None else None,
+            max=str(col_stats.max) if col_stats.max is not None else None,
+            avg_length=col_stats.avg_length,
+        )
+        for table, table_stats in stats.items()
+        for column, col_stats in table_stats.columns.items()
+    ]
+
+
+def from_stored_value(value: Optional[str], type: str) -> Any:
+    if value is None:
+        return None
+    if type == "integer":
+        return int(value)
+    if type in ("float", "decimal_comma"):
+        return float(value)
+    return value
+
+
+def from_column_stats(column_stats: list[ColumnStats]) -> dict[str, TableStatistics]:
+    """
+    the inverse of to_column_stats, only without the HyperLogLog registers
+    """
+    stats: dict[str, TableStatistics] = {}
+    for cs in column_stats:
+        table_stats = stats.setdefault(cs.table_name, TableStatistics([], []))
+        col_stats = ColumnStatistics(cs.type)
+        col_stats.total_rows = cs.total_rows
+        col_stats.null_count = cs.null_count
+        col_stats.known_distinct = cs.num_distinct
+        col_stats.min = from_stored_value(cs.min, cs.type)
+        col_stats.max = from_stored_value(cs.max, cs.type)
+        if cs.avg_length is not None:
+            col_stats.total_length = round(cs.avg_length * (cs.total_rows - cs.null_count))
+        table_stats.columns[cs.column_name] = col_stats
+        table_stats.row_count = cs.total_rows
+    return stats
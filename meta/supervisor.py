@@ -0,0 +1,152 @@
+"""
+run an import in a separate process that is stopped if it uses too much memory or takes too long,
+so that a single pathological dataset can't take down or block the task runner.
+
+The process is asked to stop first (the next `RecordLogger.set_status` call raises `ImportCancelled`)
+and is killed together with all its children if it doesn't react within `CANCEL_GRACE_PERIOD`.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from multiprocessing.connection import Connection
+from pathlib import Path
+from typing import Callable, Any, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from .progress_logger import set_cancel_event
+
+CHECK_INTERVAL = 1
+CANCEL_GRACE_PERIOD = 30
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class ImportLimits(BaseModel):
+    """
+    can be set per job in the `properties` of the job data
+    """
+    model_config = ConfigDict(extra="ignore")
+
+    max_rss_mb: Optional[int] = 4096
+    timeout_seconds: Optional[float] = 6 * 60 * 60
+
+
+class ImportFailed(Exception):
+    pass
+
+
+class ImportLimitExceeded(ImportFailed):
+    """
+    retrying won't help, as the dataset will most likely be just as large next time
+    """
+
+
+class ImportStopped(ImportFailed):
+    """
+    the import was killed because the `stop` event was set, e.g. as the job was handed to another worker
+    """
+
+
+def process_group_rss(pgid: int) -> int:
+    """
+    the resident memory of all processes in the group (the import and e.g. its process pool)
+    """
+    total = 0
+    for proc in Path("/proc").iterdir():
+        if not proc.name.isdigit():
+            continue
+        try:
+            stat = (proc / "stat").read_text()
+            # the process name in parentheses might contain spaces
+            fields = stat[stat.rindex(")") + 2:].split()
+            if int(fields[2]) != pgid:
+                continue
+            total += int((proc / "statm").read_text().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            # the process exited in the meantime
+            continue
+    return total
+
+
+def run_child(conn: Connection, cancel_event, target: Callable, args: tuple) -> None:
+    # a separate process group, so that the whole tree can be killed at once
+    os.setpgrp()
+    set_cancel_event(cancel_event)
+    try:
+        result = target(*args)
+    except BaseException as e:
+        conn.send(("error", f"{e!r}\n{traceback.format_exc()}"))
+    else:
+        conn.send(("ok", result))
+    finally:
+        conn.close()
+
+
+def kill_process_group(process: multiprocessing.Process) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # it didn't get to start its own process group yet
+        process.kill()
+    process.join()
+
+
+def run_supervised(target: Callable, args: tuple, limits: ImportLimits,
+                   cleanup: Optional[Callable[[], None]] = None, stop: Optional[threading.Event] = None) -> Any:
+    """
+    returns the result of `target(*args)` or raises `ImportFailed` (`ImportLimitExceeded` if it was stopped).
+    `cleanup` is called if the process had to be killed, as it couldn't clean up after itself.
+    If `stop` is set, the process is killed right away without `cleanup` and `ImportStopped` is raised,
+    as someone else may already work on the same files.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    cancel_event = ctx.Event()
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    # not a daemon, as the import itself starts worker processes
+    process = ctx.Process(target=run_child, args=(child_conn, cancel_event, target, args), name="import")
+    process.start()
+    child_conn.close()
+
+    start = time.monotonic()
+    cancelled_at = None
+    reason = None
+    try:
+        while not parent_conn.poll(CHECK_INTERVAL):
+            if not process.is_alive():
+                break
+            if stop is not None and stop.is_set():
+                kill_process_group(process)
+                raise ImportStopped("import stopped")
+            if cancelled_at is None:
+                if limits.timeout_seconds is not None and time.monotonic() - start > limits.timeout_seconds:
+                    reason = f"took longer than {limits.timeout_seconds} seconds"
+                elif limits.max_rss_mb is not None and \
+                        process_group_rss(process.pid) > limits.max_rss_mb * 1024 * 1024:
+                    reason = f"used more than {limits.max_rss_mb} MB of memory"
+                if reason is not None:
+                    cancel_event.set()
+                    cancelled_at = time.monotonic()
+            elif time.monotonic() - cancelled_at > CANCEL_GRACE_PERIOD:
+                kill_process_group(process)
+                if cleanup is not None:
+                    cleanup()
+                raise ImportLimitExceeded(f"import killed: {reason}")
+        try:
+            status, value = parent_conn.recv()
+        except EOFError:
+            # crashed without sending anything, e.g. killed by the OOM killer
+            kill_process_group(process)
+            if cleanup is not None:
+                cleanup()
+            raise ImportFailed(f"import process died with exit code {process.exitcode}")
+    finally:
+        parent_conn.close()
+    process.join()
+    if status == "error":
+        if reason is not None:
+            raise ImportLimitExceeded(f"import cancelled: {reason}\n{value}")
+        raise ImportFailed(value)
+    return value
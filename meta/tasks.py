@@ -1,39 +1,175 @@
+import fcntl
+import multiprocessing
+import sys
+import threading
 import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
 
 from meta import fetch_dataset, create_ds_metadata
-from meta.meta_db import meta_sqlite_conn, meta_db
-from meta.processes import restart_datasette_process
+from meta.fetcher import cleanup_import
+from meta.globals import ds_dir
+from meta.meta_db import meta_sqlite_conn, meta_db, status_notifier
+from meta.datasette_control import reload_datasette
+from meta.supervisor import ImportLimits, ImportLimitExceeded, ImportStopped, run_supervised
 from meta.utils import sd_notify
-from very_simple_task_queue import Queue
+from very_simple_task_queue import Queue, JobPriority, Job
 
-q = Queue(meta_sqlite_conn)
+q = Queue(meta_sqlite_conn, status_notifier=status_notifier)
 
+# jobs that finish within a few seconds of each other share one metadata build and Datasette restart
+RELOAD_WINDOW = 5
+# but a steady stream of jobs must not delay the restart forever
+MAX_RELOAD_DELAY = 60
+# the workers are separate processes that must not write the metadata files at the same time
+reload_lock_file = ds_dir / "reload.lock"
 
-def add_fetch_task(id: str) -> str:
-    if meta_db.total_storage()[1] / 1024 / 1024 > 500:
+
+def add_fetch_task(id: str, priority: int = JobPriority.INTERACTIVE, limits: Optional[ImportLimits] = None) -> str:
+    """
+    returns the id of the already pending fetch of this dataset if there is one
+    """
+    _, compressed_size, export_size = meta_db.total_storage()
+    # the exports take up disk space as well
+    if ((compressed_size or 0) + (export_size or 0)) / 1024 / 1024 > 500:
         raise Exception("out of disk space")
-    if meta_db.get_resource(id) is not None:
-        raise Exception("resource already exists")
     return q.put({
         "task_type": "fetch_task",
-        "properties": {}
-    }, record=id)
+        "properties": (limits or ImportLimits()).model_dump()
+    }, record=id, dedup_key=f"fetch_task:{id}", priority=priority)
 
 
-def start_task_runner():
-    sd_notify('READY=1')
+def add_refresh_tasks() -> list[str]:
+    """
+    refetch all datasets, but after any fetches requested by users
+    """
+    return [add_fetch_task(record.id, priority=JobPriority.BULK)
+            for record in meta_db.get_record_views(columns=[], with_resources=False)]
+
+
+def update_datasette(changed: set[str]):
+    with reload_lock_file.open("w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        metadata_changed = create_ds_metadata()
+        reload_datasette(changed=changed, metadata_changed=metadata_changed)
+
+
+class DatasetteReloader:
+    """
+    reloads Datasette in a background thread `RELOAD_WINDOW` seconds after the last change,
+    but at most `MAX_RELOAD_DELAY` seconds after the first one, even while the worker runs the next job
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.changed_records = set()
+        self.first_change = None
+        self.reload_at = None
+        # the worker keeps using the connection to the meta database meanwhile, so the reload runs in
+        # a separate process with its own one, which is reused, as starting it imports everything again
+        self.executor = None
+        self.thread = threading.Thread(target=self.run, name="datasette-reloader", daemon=True)
+        self.thread.start()
+
+    def add(self, record: str) -> None:
+        with self.condition:
+            now = time.monotonic()
+            self.changed_records.add(record)
+            if self.first_change is None:
+                self.first_change = now
+            self.reload_at = min(now + RELOAD_WINDOW, self.first_change + MAX_RELOAD_DELAY)
+            self.condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while self.reload_at is None or time.monotonic() < self.reload_at:
+                    self.condition.wait(self.reload_at - time.monotonic() if self.reload_at is not None else None)
+                changed = self.changed_records
+                self.changed_records = set()
+                self.first_change = self.reload_at = None
+            try:
+                self.update_datasette(changed)
+            except Exception:
+                traceback.print_exc()
+
+    def update_datasette(self, changed: set[str]) -> None:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            self.executor.submit(update_datasette, changed).result()
+        except BrokenProcessPool:
+            # e.g. killed, the next reload starts a new process
+            self.executor = None
+            raise
+
+
+def run_job(job: Job) -> bool:
+    """
+    returns whether Datasette needs to be reloaded
+    """
+    if job.data["task_type"] == "fetch_task":
+        limits = ImportLimits(**job.data.get("properties", {}))
+        with q.keep_alive(job) as lease_lost:
+            return run_supervised(fetch_dataset, (job.record, job.id), limits,
+                                  cleanup=lambda: cleanup_import(job.record), stop=lease_lost)
+    raise ValueError(f"unknown task type {job.data['task_type']}")
+
+
+def set_job_failed(job: Job, error: str, retry: bool = True) -> None:
+    if not q.set_job_failed(job, error, retry):
+        print(f"job {job.id} was handed to another worker before it failed", file=sys.stderr)
+
+
+def start_task_runner(worker_id: Optional[str] = None):
+    reloader = DatasetteReloader()
     while True:
-        job = q.get_next_job()
+        job = q.get(worker_id=worker_id)
         if job is None:
-            time.sleep(.25)
             continue
         print(job)
-        if job.data["task_type"] == "fetch_task":
-            fetch_dataset(job.record, task_id=job.id)
-            create_ds_metadata()
-            restart_datasette_process()
-            q.set_job_done(job)
+        try:
+            changed = run_job(job)
+        except ImportStopped:
+            # the job belongs to another worker now
+            print(f"stopped job {job.id} after losing its lease", file=sys.stderr)
+            continue
+        except ImportLimitExceeded as e:
+            print(e, file=sys.stderr)
+            set_job_failed(job, str(e), retry=False)
+            continue
+        except Exception as e:
+            traceback.print_exc()
+            set_job_failed(job, repr(e))
+            continue
+        if not q.set_job_done(job):
+            print(f"job {job.id} was handed to another worker before it finished", file=sys.stderr)
+        if changed:
+            reloader.add(job.record)
+
+
+def start_task_runners(num_workers: int):
+    """
+    every worker is a separate process with its own connection to the queue
+    """
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=start_task_runner, name=f"worker-{i}") for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    sd_notify('READY=1')
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == '__main__':
-    start_task_runner()
+    if len(sys.argv) > 1 and sys.argv[1] == "refresh":
+        print(add_refresh_tasks())
+        sys.exit()
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if num_workers == 1:
+        sd_notify('READY=1')
+        start_task_runner()
+    else:
+        start_task_runners(num_workers)
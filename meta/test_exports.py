@@ -0,0 +1,64 @@
+import csv
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
+
+from meta import exports
+from meta.exports import arrow_schema, to_arrow_batch, create_exports, exports_size
+
+
+class PrintLogger:
+    def set_status(self, status: str):
+        print(status)
+
+
+def create_db(path) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE "data" (name TEXT, year INTEGER, value REAL, mixed INTEGER, raw BLOB, other TEXT)')
+    conn.executemany('INSERT INTO "data" VALUES (?, ?, ?, ?, ?, ?)', [
+        ("Wien", 2020, 1.5, 1, b"\x00\x01", "a"),
+        ("Graz", None, 2, "x", None, b"\xff"),
+    ])
+    conn.execute('CREATE TABLE "data/2" (x INTEGER)')
+    conn.commit()
+    conn.close()
+
+
+def test_arrow_schema(tmp_path):
+    create_db(tmp_path / "test.db")
+    conn = sqlite3.connect(tmp_path / "test.db")
+    schema = arrow_schema(conn, "data")
+    assert schema.types == [pa.string(), pa.int64(), pa.float64(), pa.string(), pa.binary(), pa.binary()]
+    batch = to_arrow_batch(conn.execute('SELECT * FROM "data"').fetchall(), schema)
+    assert batch.to_pylist() == [
+        {"name": "Wien", "year": 2020, "value": 1.5, "mixed": "1", "raw": b"\x00\x01", "other": b"a"},
+        {"name": "Graz", "year": None, "value": 2.0, "mixed": "x", "raw": None, "other": b"\xff"},
+    ]
+
+
+def test_create_exports(tmp_path, monkeypatch):
+    monkeypatch.setattr(exports, "exports_dir", tmp_path / "exports")
+    create_db(tmp_path / "test.db")
+    manifest = create_exports("test", tmp_path / "test.db", "hash 1", PrintLogger())
+    assert manifest["tables"]["data"]["rows"] == 2
+    assert manifest["tables"]["data/2"]["parquet"] == "data_2.parquet"
+    assert exports_size(manifest) == sum(f.stat().st_size for f in (tmp_path / "exports" / "test").glob("data*"))
+
+    table = pq.read_table(tmp_path / "exports" / "test" / "data.parquet")
+    assert table.column("raw").to_pylist() == [b"\x00\x01", None]
+    with zstandard.open(tmp_path / "exports" / "test" / "data.csv.zst", "rt", encoding="utf-8", newline="") as f:
+        assert list(csv.reader(f)) == [
+            ["name", "year", "value", "mixed", "raw", "other"],
+            ["Wien", "2020", "1.5", "1", "0001", "a"],
+            ["Graz", "", "2.0", "x", "", "ff"],
+        ]
+
+    # the exports are only recreated for another version of the database
+    (tmp_path / "exports" / "test" / "data.parquet").unlink()
+    assert create_exports("test", tmp_path / "test.db", "hash 1", PrintLogger()) == manifest
+    assert not (tmp_path / "exports" / "test" / "data.parquet").exists()
+    assert create_exports("test", tmp_path / "test.db", "hash 2", PrintLogger())["hash"] == "hash 2"
+    assert (tmp_path / "exports" / "test" / "data.parquet").exists()
+    assert list((tmp_path / "exports").iterdir()) == [tmp_path / "exports" / "test"]
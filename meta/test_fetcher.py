@@ -0,0 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+from requests import Response
+from sqlite_utils import Database
+
+from meta import fetcher
+from meta.ds_metadata import Tweaks, ResourceTweaks
+from meta.meta_db import Resource
+
+
+class PrintLogger:
+    def __init__(self, record_id: str = "test", task_id: str = None):
+        self.record_id = record_id
+        self.task_id = task_id
+
+    def set_status(self, status: str):
+        print(status)
+
+
+def resource(i: int, name: str) -> Resource:
+    return Resource(id=f"resource-{i}", record="test", format="CSV", name=name, url=f"https://example.com/{i}.csv",
+                    mimetype="text/csv", last_fetched=datetime.now())
+
+
+@pytest.fixture
+def local_fetch(tmp_path, monkeypatch):
+    """
+    the resources are "downloaded" from `files` (by their URL) and imported in threads instead of processes
+    """
+    files = {}
+
+    def request_resource(resource, tweaks, logger, headers=None):
+        if files[resource.url] is None:
+            raise ConnectionError(f"can't reach {resource.url}")
+        # the first resource arrives last
+        if resource.url.endswith("/1.csv"):
+            time.sleep(0.2)
+        r = Response()
+        r.status_code = 200
+        r.raw = files[resource.url].open("rb")
+        return r
+
+    monkeypatch.setattr(fetcher, "ds_dir", tmp_path)
+    monkeypatch.setattr(fetcher, "request_resource", request_resource)
+    monkeypatch.setattr(fetcher, "RecordLogger", PrintLogger)
+    monkeypatch.setattr(fetcher, "ProcessPoolExecutor",
+                        lambda max_workers, mp_context, **kwargs: ThreadPoolExecutor(max_workers, **kwargs))
+    return files
+
+
+def fetch(tmp_path, files: dict, resources: list[tuple[Resource, str]]):
+    for res, content in resources:
+        if content is None:
+            files[res.url] = None
+        else:
+            files[res.url] = tmp_path / f"{res.id}.csv"
+            files[res.url].write_text(content)
+    db = Database(tmp_path / "test.db")
+    stats = {}
+    imported = []
+    to_fetch = [(i, res, ResourceTweaks()) for i, (res, _) in enumerate(resources, start=1)]
+    fetcher.fetch_resources_concurrently(db, to_fetch, Tweaks(), PrintLogger(), len(to_fetch), stats, None,
+                                         imported)
+    return db, stats, imported
+
+
+def test_fetch_resources_concurrently(tmp_path, local_fetch):
+    resources = [
+        (resource(1, "orte"), "name;value\nWien;1\nGraz;2\n"),
+        (resource(2, "andere"), "name;value\nLinz;3\n"),
+        # the same table name, so the rows are appended
+        (resource(3, "orte"), "name;value\nSalzburg;4\n"),
+    ]
+    db, stats, imported = fetch(tmp_path, local_fetch, resources)
+    # merged in the order of the resources, not in the order in which they were downloaded
+    assert [row["name"] for row in db["orte"].rows] == ["Wien", "Graz", "Salzburg"]
+    assert [row["name"] for row in db["andere"].rows] == ["Linz"]
+    assert stats["orte"].row_count == 3
+    assert [res.id for res in imported] == ["resource-1", "resource-2", "resource-3"]
+    assert imported[2].tables == ["orte"]
+    assert not list(tmp_path.glob(".test-staging-*"))
+
+
+def test_staging_is_removed_on_failure(tmp_path, local_fetch):
+    resources = [
+        (resource(1, "orte"), "name;value\nWien;1\n"),
+        (resource(2, "andere"), None),
+    ]
+    with pytest.raises(ConnectionError):
+        fetch(tmp_path, local_fetch, resources)
+    assert not list(tmp_path.glob(".test-staging-*"))
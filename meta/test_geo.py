@@ -0,0 +1,45 @@
+import io
+import json
+
+import pytest
+
+from meta import geo
+from meta.download import Download
+from meta.geo import iter_features, is_wfs_get_feature, GeoJSONError
+
+
+def download(text: str) -> Download:
+    data = text.encode()
+    return Download(io.BytesIO(data), len(data), "utf-8")
+
+
+def test_iter_features(monkeypatch):
+    # features that are split between chunks
+    monkeypatch.setattr(geo, "READ_SIZE", 7)
+    features = [
+        {"type": "Feature", "properties": {"name": f"Ort {i}", "text": "a, ] }"},
+         "geometry": {"type": "Point", "coordinates": [i, i]}}
+        for i in range(20)
+    ]
+    collection = {"type": "FeatureCollection", "name": "features: [", "features": features}
+    assert list(iter_features(download(json.dumps(collection)))) == features
+    assert list(iter_features(download(json.dumps(collection, indent=2)))) == features
+    assert list(iter_features(download(json.dumps(features[0])))) == features[:1]
+
+
+def test_invalid_geojson(monkeypatch):
+    with pytest.raises(GeoJSONError):
+        list(iter_features(download('<?xml version="1.0"?><wfs:WFS_Capabilities/>')))
+    with pytest.raises(GeoJSONError):
+        list(iter_features(download('{"type": "FeatureCollection", "features": [{"type": "Feature"}, {"ty')))
+    # documents without features aren't buffered completely
+    monkeypatch.setattr(geo, "READ_SIZE", 10)
+    monkeypatch.setattr(geo, "MAX_PRESCAN_SIZE", 100)
+    with pytest.raises(GeoJSONError):
+        list(iter_features(download(json.dumps({"type": "FeatureCollection", "items": list(range(100))}))))
+
+
+def test_is_wfs_get_feature():
+    assert is_wfs_get_feature("https://example.com/wfs?SERVICE=WFS&REQUEST=GetFeature&typeName=x")
+    assert not is_wfs_get_feature("https://example.com/wfs?service=WFS&request=GetCapabilities")
+    assert not is_wfs_get_feature("https://example.com/wfs")
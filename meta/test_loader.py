@@ -0,0 +1,96 @@
+from sqlite_utils import Database
+
+from meta.loader import load_table, guess_column_types, unique_column_names, copy_tables
+
+
+class PrintLogger:
+    def set_status(self, status: str):
+        print(status)
+
+
+def test_guess_column_types():
+    rows = [
+        ["1", "1.5", "a", ""],
+        ["2", "3", "4", ""],
+        ["", "", "", ""],
+    ]
+    assert guess_column_types(rows, 4) == ["integer", "float", "text", "integer"]
+
+
+def test_unique_column_names():
+    assert unique_column_names(["a", "A", "", "b", "a"]) == ["a", "A_2", "column_3", "b", "a_3"]
+
+
+def test_load_table():
+    db = Database(memory=True)
+    header = ["name", "year", "value"]
+    data = [
+        ["Wien", "2020", "1.5"],
+        ["Graz", "", "2"],
+        ["Linz", "2022"],
+    ]
+    stats = load_table(db, "test", header, lambda: iter(data), PrintLogger())
+    assert stats.row_count == 3
+    assert stats.get("year").null_count == 1
+    assert db["test"].columns_dict == {"name": str, "year": int, "value": float}
+    assert list(db["test"].rows) == [
+        {"name": "Wien", "year": 2020, "value": 1.5},
+        {"name": "Graz", "year": None, "value": 2.0},
+        {"name": "Linz", "year": 2022, "value": None},
+    ]
+
+
+def test_decimal_comma_columns():
+    db = Database(memory=True)
+    header = ["value", "text", "dot"]
+    data = [
+        ["1.234,5", "Wien, Innere Stadt", "1.5"],
+        ["-12,25", "Graz", "2"],
+        ["3", "", ""],
+    ]
+    load_table(db, "test", header, lambda: iter(data), PrintLogger())
+    assert db["test"].columns_dict == {"value": float, "text": str, "dot": float}
+    assert [tuple(r.values()) for r in db["test"].rows] == [
+        (1234.5, "Wien, Innere Stadt", 1.5),
+        (-12.25, "Graz", 2.0),
+        (3.0, "", None),
+    ]
+
+
+def test_rows_wider_than_header():
+    db = Database(memory=True)
+    data = [
+        ["Bezirk", "2019", "2020", None],
+        ["Wien", 1, 2],
+    ]
+    load_table(db, "t", ["Tabelle 1: Bevölkerung"], lambda: iter(data), PrintLogger())
+    assert [c.name for c in db["t"].columns] == ["Tabelle 1: Bevölkerung", "column_2", "column_3"]
+    assert list(db.execute("SELECT * FROM t").fetchall()) == [("Bezirk", 2019, 2020), ("Wien", 1, 2)]
+
+
+def test_numbers_that_are_not_integers():
+    db = Database(memory=True)
+    data = [
+        ["12345678901234567890123", "1_000", "9223372036854775807"],
+        ["1", "2", "-9223372036854775808"],
+    ]
+    load_table(db, "t", ["account", "underscore", "id"], lambda: iter(data), PrintLogger())
+    assert [c.type for c in db["t"].columns] == ["REAL", "TEXT", "INTEGER"]
+    assert db.execute("SELECT * FROM t").fetchall() == [
+        (1.2345678901234568e+22, "1_000", 9223372036854775807),
+        (1.0, "2", -9223372036854775808),
+    ]
+
+
+def test_copy_tables(tmp_path):
+    for i, rows in enumerate([[{"x": 1}, {"x": 2}], [{"x": 3}]]):
+        source = Database(tmp_path / f"source{i}.db")
+        source["data"].insert_all(rows)
+        source[f"only_{i}"].insert({"y": "a"})
+        source.close()
+    db = Database(memory=True)
+    assert copy_tables(db, tmp_path / "source0.db") == ["data", "only_0"]
+    # tables that already exist are appended to
+    assert copy_tables(db, tmp_path / "source1.db", tables=["data"]) == ["data"]
+    assert [row["x"] for row in db["data"].rows] == [1, 2, 3]
+    assert db.table_names() == ["data", "only_0"]
@@ -0,0 +1,35 @@
+import numpy as np
+
+from meta.statistics import HyperLogLog, TableStatistics, ColumnStatistics
+
+
+def test_hyperloglog_small():
+    hll = HyperLogLog()
+    hll.add(np.asarray([f"value {i % 30}" for i in range(1000)], dtype=object))
+    assert hll.count() == 30
+
+
+def test_hyperloglog_large():
+    hll = HyperLogLog()
+    hll.add(np.arange(100_000).astype(object))
+    assert abs(hll.count() - 100_000) < 100_000 * 0.05
+
+
+def test_table_statistics_merge():
+    a = TableStatistics(["x", "y"], ["integer", "text"])
+    a.update([[1, 2, None], ["a", "b", "b"]])
+    b = TableStatistics(["x", "y"], ["integer", "text"])
+    b.update([[5, 2], ["c", None]])
+    a.merge(b)
+    x, y = a.get("x"), a.get("y")
+    assert a.row_count == 5
+    assert (x.total_rows, x.null_count, x.num_distinct, x.min, x.max) == (5, 1, 3, 1, 5)
+    assert (y.total_rows, y.null_count, y.num_distinct, y.min, y.max) == (5, 1, 3, "a", "c")
+
+
+def test_avg_length():
+    stats = ColumnStatistics("text")
+    stats.update(["ab", "abcd", None])
+    stats.update(["abc"])
+    assert stats.avg_length == 3
+    assert ColumnStatistics("integer").avg_length is None
@@ -1,10 +1,16 @@
+import asyncio
+import json
+import time
+
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse, Response
 from starlette.routing import Route, Mount
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
-from meta.meta_db import meta_db
+from meta.async_db import read, write
+from meta.exports import exports_dir, current_exports
+from meta.meta_db import MetaDatabase, RecordView, status_notifier
 from meta.progress_logger import RecordLogger
 from meta.tasks import add_fetch_task, q
 from meta.utils import pretty_byte_size
@@ -13,31 +19,54 @@ templates = Jinja2Templates(directory='templates')
 templates.env.filters['pretty_byte_size'] = pretty_byte_size
 
 
+RECORDS_PER_PAGE = 50
+# an import logs a lot, the browser doesn't need more than a few updates per second
+MIN_EVENT_INTERVAL = 0.25
+# comment lines keep proxies from closing idle event streams
+KEEP_ALIVE_INTERVAL = 15
+
+
 async def home(request):
-    records = meta_db.get_records()
-    total_storage = meta_db.total_storage()
-    print(total_storage)
+    search = request.query_params.get("q", "").strip()
+    sort = request.query_params.get("sort", "relevance" if search else "title")
+    try:
+        page = max(int(request.query_params.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    # both queries run concurrently in the read pool
+    (records, num_records), total_storage = await asyncio.gather(
+        read(MetaDatabase.list_records, page, RECORDS_PER_PAGE, sort, search or None),
+        read(MetaDatabase.total_storage),
+    )
     return templates.TemplateResponse(request, 'index.html', context={
         "records": records,
-        "total_storage": total_storage[0] / 1024 / 1024,
-        "total_storage_comp": total_storage[1] / 1024 / 1024,
+        "num_records": num_records,
+        "page": page,
+        "num_pages": max((num_records + RECORDS_PER_PAGE - 1) // RECORDS_PER_PAGE, 1),
+        "search": search,
+        "sort": sort,
+        "total_storage": (total_storage[0] or 0) / 1024 / 1024,
+        "total_storage_comp": (total_storage[1] or 0) / 1024 / 1024,
     })
 
 
+def task_sets_for_record(db: MetaDatabase, record: RecordView) -> list:
+    return [(task, RecordLogger.get_all_status_by_task_id(task.id, db)) for task in db.get_tasks_for_record(record)]
+
+
 async def show(request):
     id = request.path_params['id']
-    resource = meta_db.get_record(id=id)
+    records = await read(MetaDatabase.get_record_views, ids=[id], columns=[
+        "title", "db_size", "compressed_size", "inspect_data"
+    ])
 
-    if resource is None:
+    if not records:
         return templates.TemplateResponse(request, 'confirm_fetch.html', context={'id': id})
 
-    record = meta_db.get_record(id=id)
-    resources = meta_db.get_resources(record=record)
-    tasks = meta_db.get_tasks_for_record(record=record)
-    task_sets=[]
-    for task in tasks:
-        logging = RecordLogger.get_all_status_by_task_id(task.id)
-        task_sets.append((task,logging))
+    record = records[0]
+    resources = record.resources
+    task_sets = await read(task_sets_for_record, record)
+    exports = current_exports(id, json.loads(record.inspect_data)["hash"]) if record.inspect_data else None
 
 
     return templates.TemplateResponse(
@@ -45,7 +74,8 @@ async def show(request):
         context={
             'id': id, "record": record,
             "resources": resources,
-            "tasks": task_sets
+            "tasks": task_sets,
+            "exports": exports,
         })
 
     # return RedirectResponse(request.url_for('fetch_start', id=id))
@@ -58,7 +88,7 @@ async def show(request):
 async def fetch(request):
     id = request.path_params['id']
     # TODO: add a check to only fetch if the
-    task_id = add_fetch_task(id)
+    task_id = await write(add_fetch_task, id)
     # need 303 to make POST a GET request
     return RedirectResponse(request.url_for("task_page", task_id=task_id), status_code=303)
 
@@ -68,11 +98,10 @@ async def task_page(request):
     return templates.TemplateResponse(request, 'fetch.html', context={'task_id': task_id})
 
 
-async def task_status(request):
-    task_id = request.path_params['task_id']
-    task = q.get_job_status(task_id)
+def task_status_data(db: MetaDatabase, request, task_id: str) -> dict:
+    task = q.get_job_status(task_id, db.conn)
     try:
-        status = RecordLogger.get_latest_status_by_task_id(task_id)
+        status = RecordLogger.get_latest_status_by_task_id(task_id, db)
     except TypeError:
         status = "unknown"
 
@@ -80,8 +109,48 @@ async def task_status(request):
         redirect_url = request.url_for("show", id=task.record).path
     else:
         redirect_url = None
-    return JSONResponse(
-        {'status': status, "task_status": task.status, "task_data": task.data, "redirect_url": redirect_url})
+    return {'status': status, "task_status": task.status, "task_data": task.data, "redirect_url": redirect_url}
+
+
+async def task_status(request):
+    task_id = request.path_params['task_id']
+    return JSONResponse(await read(task_status_data, request, task_id))
+
+
+async def task_events(request):
+    """
+    pushes the status as server-sent events whenever it changes, until the task is done or failed
+    """
+    task_id = request.path_params['task_id']
+    try:
+        await read(lambda db: q.get_job_status(task_id, db.conn))
+    except TypeError:
+        return Response("unknown task", status_code=404)
+
+    async def events():
+        last_data = None
+        last_sent = time.monotonic()
+        # listen before reading the status, so that no change in between gets lost
+        with status_notifier.listen(task_id) as listener:
+            while True:
+                data = await read(task_status_data, request, task_id)
+                if data != last_data:
+                    yield f"data: {json.dumps(data)}\n\n"
+                    last_data = data
+                    last_sent = time.monotonic()
+                if data["task_status"] in (2, 3):
+                    return
+                if time.monotonic() - last_sent >= KEEP_ALIVE_INTERVAL:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+                await listener.wait_async(KEEP_ALIVE_INTERVAL)
+                await asyncio.sleep(MIN_EVENT_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # e.g. nginx would otherwise buffer the whole response
+        "X-Accel-Buffering": "no",
+    })
 
 
 app = Starlette(debug=True, routes=[
@@ -90,5 +159,7 @@ app = Starlette(debug=True, routes=[
     Route('/meta/{id}/fetch', fetch, name='fetch_start', methods=["POST"]),
     Route('/meta/task/{task_id}', task_page, name='task_page'),
     Route('/meta/task/{task_id}/status', task_status, name='task_status'),
+    Route('/meta/task/{task_id}/events', task_events, name='task_events'),
+    Mount('/meta/exports', app=StaticFiles(directory=exports_dir, check_dir=False), name="exports"),
     Mount('/meta/static', app=StaticFiles(directory='static',follow_symlink=True), name="static"),
 ])
@@ -1 +1 @@
-from .queue import Queue, Job, JobStatus
+from .queue import Queue, Job, JobStatus, JobPriority
@@ -0,0 +1,121 @@
+"""
+wake up processes waiting for something (e.g. a new job) without them having to poll the database.
+
+Every listener binds a Unix datagram socket in a shared directory and the notifying process
+sends a byte to all of them. Notifications are only a hint, so everything still works
+(just slower) if they get lost, e.g. because the directory is not writable.
+A notification can be about a topic (e.g. a job id), listeners for a topic ignore all others.
+"""
+import asyncio
+import os
+import select
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Iterator
+
+MAX_MESSAGE_SIZE = 256
+
+
+class Listener:
+    def __init__(self, sock: Optional[socket.socket], topic: Optional[str] = None):
+        self.sock = sock
+        self.topic = topic.encode() if topic is not None else None
+
+    def matches(self, message: bytes) -> bool:
+        return self.topic is None or message == self.topic
+
+    def wait(self, timeout: float) -> bool:
+        """
+        returns True if a notification (about the topic of the listener) arrived within `timeout` seconds
+        """
+        if self.sock is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.monotonic() + timeout
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], max(deadline - time.monotonic(), 0))
+            if not readable:
+                return False
+            if self.drain():
+                return True
+
+    async def wait_async(self, timeout: float) -> bool:
+        """
+        like `wait`, but doesn't block the event loop
+        """
+        if self.sock is None:
+            await asyncio.sleep(timeout)
+            return False
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                message = await asyncio.wait_for(asyncio.get_running_loop().sock_recv(self.sock, MAX_MESSAGE_SIZE),
+                                                 max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                return False
+            if self.drain() or self.matches(message):
+                return True
+
+    def drain(self) -> bool:
+        """
+        several notifications might have piled up, returns whether one of them was about the topic
+        """
+        matched = False
+        try:
+            while True:
+                matched = self.matches(self.sock.recv(MAX_MESSAGE_SIZE)) or matched
+        except BlockingIOError:
+            pass
+        return matched
+
+
+class Notifier:
+    def __init__(self, directory: Optional[Path]):
+        self.directory = directory
+
+    def notify(self, topic: Optional[str] = None) -> None:
+        if self.directory is None:
+            return
+        message = topic.encode() if topic is not None else b"1"
+        try:
+            socket_files = list(self.directory.glob("*.sock"))
+        except OSError:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for socket_file in socket_files:
+                try:
+                    sock.sendto(message, str(socket_file))
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # the listener is gone without cleaning up
+                    socket_file.unlink(missing_ok=True)
+                except OSError:
+                    # e.g. the buffer of the listener is full, so it will wake up anyway
+                    pass
+        finally:
+            sock.close()
+
+    @contextmanager
+    def listen(self, topic: Optional[str] = None) -> Iterator[Listener]:
+        if self.directory is None:
+            yield Listener(None, topic)
+            return
+        socket_file = self.directory / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock"
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.directory.mkdir(exist_ok=True)
+            sock.bind(str(socket_file))
+        except OSError:
+            sock.close()
+            yield Listener(None, topic)
+            return
+        sock.setblocking(False)
+        try:
+            yield Listener(sock, topic)
+        finally:
+            sock.close()
+            socket_file.unlink(missing_ok=True)
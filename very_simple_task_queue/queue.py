@@ -1,21 +1,34 @@
 """
 This is mainly based on https://github.com/litements/litequeue
 
-It for sure is massivly limited (especially if multiple workers would be used),
-but should work for now and only uses SQLite
+It for sure is massivly limited, but should work for now and only uses SQLite.
 
+Multiple workers (also in different processes) can use the same queue:
+a job is leased to a worker for `lease_duration` seconds and the worker needs to renew
+the lease regularly (see `Queue.keep_alive`). Jobs with an expired lease (e.g. because the
+worker crashed) are handed out again until they failed `max_attempts` times.
+
+Waiting workers are woken up by `put` via Unix sockets next to the database file (see `notify.py`)
+and only poll every `poll_interval` seconds as a fallback.
+Whoever follows the progress of jobs can pass a `status_notifier` that is notified (with the job id as topic)
+when a job is claimed, done or failed.
 """
 import json
+import os
 import sqlite3
 import sys
+import threading
 import time
 import uuid
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
 from enum import IntEnum
 from pathlib import Path
 from typing import Optional
 
+from .notify import Notifier
+
 
 @dataclass(frozen=True)
 class Job:
@@ -24,18 +37,55 @@ class Job:
     record: Optional[str]
     data: dict
     in_time: float
+    attempts: int = 0
+    worker_id: Optional[str] = None
+    priority: int = 0
 
 
 class JobStatus(IntEnum):
     PENDING = 0
     IN_PROGRESS = 1
     DONE = 2
+    FAILED = 3
+
+
+class JobPriority(IntEnum):
+    """
+    jobs with a higher priority are handed out first
+    """
+    BULK = 0
+    NORMAL = 10
+    INTERACTIVE = 20
+
+
+def default_worker_id() -> str:
+    return f"{os.uname().nodename}-{os.getpid()}-{threading.get_ident()}"
+
+
+# pending jobs (or ones whose lease expired) that can be claimed, except if another job of the same
+# record is running, as the jobs of one record usually work on the same files
+CLAIMABLE_JOBS = """
+    (status=0 OR (status=1 AND lease_until < :now))
+    AND (record IS NULL OR record NOT IN (
+        SELECT record FROM queue WHERE status=1 AND lease_until >= :now AND record IS NOT NULL))
+"""
 
 
 class Queue:
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(self, conn: sqlite3.Connection, lease_duration: float = 60, max_attempts: int = 3,
+                 poll_interval: float = 10, status_notifier: Optional[Notifier] = None):
         self.conn = conn
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
         self.init_tables()
+        db_file = self.db_file()
+        self.notifier = Notifier(Path(db_file + "-queue-notify") if db_file else None)
+        self.status_notifier = status_notifier or Notifier(None)
+
+    def db_file(self) -> str:
+        # empty for in-memory databases
+        return self.conn.execute("SELECT file FROM pragma_database_list WHERE name = 'main'").fetchone()[0]
 
     def init_tables(self):
         self.conn.execute("""
@@ -51,46 +101,213 @@ class Queue:
 
         self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS queue_idx ON queue (job_id)")
 
+        # columns that were added later
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(queue)")}
+        for column, definition in [
+            ("worker_id", "TEXT"),
+            ("lease_until", "REAL"),
+            ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+            ("error", "TEXT"),
+            ("dedup_key", "TEXT"),
+            ("priority", "INTEGER NOT NULL DEFAULT 0"),
+        ]:
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE queue ADD COLUMN {column} {definition}")
+        self.conn.commit()
+
         self.conn.execute("CREATE INDEX IF NOT EXISTS status_idx ON queue (status)")
         self.conn.execute("CREATE INDEX IF NOT EXISTS record_idx ON queue (record)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS next_job_idx ON queue (status, priority DESC, in_time)")
+        # at most one pending job per dedup key
+        self.conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS dedup_idx ON queue (dedup_key) WHERE status=0 AND dedup_key IS NOT NULL")
         self.conn.execute("PRAGMA journal_mode = WAL;")
         self.conn.execute("PRAGMA temp_store = MEMORY;")
         self.conn.execute("PRAGMA synchronous = NORMAL;")
 
-    def put(self, data, record=None) -> str:
+    def put(self, data, record=None, dedup_key: Optional[str] = None, priority: int = JobPriority.NORMAL) -> str:
+        """
+        if a pending job with the same `dedup_key` exists, no new job is added. Instead, the existing one
+        gets the new data and the higher of both priorities and its id is returned.
+        """
         job_id = uuid.uuid4()
         now = datetime.now().timestamp()
         with self.conn:
-            self.conn.execute(
-                """INSERT INTO queue (data, job_id, status, record, in_time)
-                   VALUES (:data, :job_id, :status, :record, :now)""",
-                {"data": json.dumps(data), "job_id": job_id.hex, "status": 0, "record": record, "now": now})
-        return job_id.hex
+            job_id = self.conn.execute(
+                """INSERT INTO queue (data, job_id, status, record, in_time, dedup_key, priority)
+                   VALUES (:data, :job_id, :status, :record, :now, :dedup_key, :priority)
+                   ON CONFLICT (dedup_key) WHERE status=0 AND dedup_key IS NOT NULL
+                   DO UPDATE SET data = excluded.data, priority = max(priority, excluded.priority)
+                   RETURNING job_id""",
+                {"data": json.dumps(data), "job_id": job_id.hex, "status": 0, "record": record, "now": now,
+                 "dedup_key": dedup_key, "priority": int(priority)}).fetchone()[0]
+        self.notifier.notify()
+        return job_id
+
+    def has_available_job(self) -> bool:
+        """
+        a cheap read-only check, so that idle workers don't need to start write transactions
+        """
+        return self.conn.execute(
+            f"SELECT 1 FROM queue WHERE {CLAIMABLE_JOBS} LIMIT 1",
+            {"now": datetime.now().timestamp()}).fetchone() is not None
+
+    def get(self, timeout: Optional[float] = None, worker_id: Optional[str] = None) -> Optional[Job]:
+        """
+        blocks until a job is available (or `timeout` seconds passed)
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        # listen before checking the queue, so that no notification in between gets lost
+        with self.notifier.listen() as listener:
+            while True:
+                if self.has_available_job():
+                    job = self.get_next_job(worker_id)
+                    if job is not None:
+                        return job
+                wait = self.poll_interval
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait, remaining)
+                listener.wait(wait)
 
-    def get_next_job(self) -> Optional[Job]:
+    def get_next_job(self, worker_id: Optional[str] = None) -> Optional[Job]:
+        """
+        claims the oldest pending job (or one whose lease expired) of the highest priority
+        whose record has no other running job.
+        SQLite only allows one writer at a time, so two workers can never claim the same job.
+        """
         now = datetime.now().timestamp()
+        params = {
+            "now": now,
+            "lease_until": now + self.lease_duration,
+            "worker_id": worker_id or default_worker_id(),
+            "max_attempts": self.max_attempts,
+        }
         with self.conn:
+            if not self.conn.in_transaction:
+                # take the write lock right away, so that concurrent workers wait for each other
+                self.conn.execute("BEGIN IMMEDIATE")
+            # jobs that crashed their worker too often are given up
+            self.conn.execute(
+                "UPDATE queue SET status=3, error='lease expired too often' "
+                "WHERE status=1 AND lease_until < :now AND attempts >= :max_attempts", params)
             resp = self.conn.execute(
-                "UPDATE queue SET status=1, lock_time = :now WHERE job_id = (SELECT job_id FROM queue WHERE status=0 ORDER BY in_time LIMIT 1) RETURNING job_id,status,record,data,in_time",
-                {"now": now}).fetchone()
+                f"""UPDATE queue
+                   SET status=1, lock_time = :now, lease_until = :lease_until, worker_id = :worker_id,
+                       attempts = attempts + 1
+                   WHERE job_id = (SELECT job_id FROM queue
+                                   WHERE {CLAIMABLE_JOBS}
+                                   ORDER BY priority DESC, in_time LIMIT 1)
+                   RETURNING job_id,status,record,data,in_time,attempts,worker_id,priority""",
+                params).fetchone()
         if resp is None:
             return None
-        job_id, status, record, data, in_time = resp
-        return Job(job_id, status, record, json.loads(data), in_time)
+        job_id, status, record, data, in_time, attempts, worker_id, priority = resp
+        self.status_notifier.notify(job_id)
+        return Job(job_id, status, record, json.loads(data), in_time, attempts, worker_id, priority)
+
+    def renew_lease(self, job: Job, conn: Optional[sqlite3.Connection] = None) -> bool:
+        """
+        returns False if the job was meanwhile handed to another worker
+        """
+        conn = conn or self.conn
+        with conn:
+            cur = conn.execute(
+                "UPDATE queue SET lease_until = :lease_until WHERE job_id = :job_id AND worker_id = :worker_id AND status=1",
+                {"lease_until": datetime.now().timestamp() + self.lease_duration, "job_id": job.id,
+                 "worker_id": job.worker_id})
+        return cur.rowcount == 1
+
+    @contextmanager
+    def keep_alive(self, job: Job):
+        """
+        renews the lease of the job in a background thread (with its own connection) while it is processed.
+        Yields an event that is set if the lease was lost, the job should be stopped then,
+        as it may already run on another worker.
+        """
+        db_file = self.db_file()
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            conn = sqlite3.connect(db_file, timeout=30)
+            try:
+                while not stop.wait(self.lease_duration / 3):
+                    try:
+                        renewed = self.renew_lease(job, conn)
+                    except sqlite3.OperationalError as e:
+                        # e.g. locked for too long, the lease may still be renewed in time next round
+                        print(f"couldn't renew the lease of job {job.id}: {e}", file=sys.stderr)
+                        continue
+                    if not renewed:
+                        print(f"lost the lease of job {job.id}", file=sys.stderr)
+                        lost.set()
+                        return
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=heartbeat, name=f"heartbeat-{job.id}", daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def set_job_done(self, job: Job) -> bool:
+        """
+        returns False if the job was meanwhile handed to another worker, it is left alone then
+        """
+        with self.conn:
+            cur = self.conn.execute(
+                "UPDATE queue SET status=2, lease_until=NULL WHERE job_id= :job_id AND worker_id = :worker_id AND status=1",
+                {"job_id": job.id, "worker_id": job.worker_id})
+        if cur.rowcount != 1:
+            return False
+        self.status_notifier.notify(job.id)
+        # jobs of the same record can be claimed now
+        self.notifier.notify()
+        return True
 
-    def set_job_done(self, job: Job) -> None:
+    def set_job_failed(self, job: Job, error: str, retry: bool = True) -> bool:
+        """
+        the job is tried again later unless `retry` is False, it already failed `max_attempts` times
+        or another pending job with the same `dedup_key` was added while it ran (which will do the retry).
+        Like `set_job_done` returns False if the job was meanwhile handed to another worker.
+        """
+        status = JobStatus.FAILED if not retry or job.attempts >= self.max_attempts else JobStatus.PENDING
         with self.conn:
-            self.conn.execute("UPDATE queue SET status=2 WHERE job_id= :job_id", {"job_id": job.id})
+            cur = self.conn.execute(
+                """UPDATE queue
+                   SET status = CASE WHEN :status = 0 AND EXISTS (
+                           SELECT 1 FROM queue AS pending
+                           WHERE pending.dedup_key = queue.dedup_key AND pending.status = 0
+                       ) THEN 3 ELSE :status END,
+                       lease_until=NULL, error=:error
+                   WHERE job_id= :job_id AND worker_id = :worker_id AND status=1""",
+                {"status": int(status), "error": error, "job_id": job.id, "worker_id": job.worker_id})
+        if cur.rowcount != 1:
+            return False
+        self.status_notifier.notify(job.id)
+        self.notifier.notify()
+        return True
 
-    def get_job_status(self, job_id: str) -> Job:
-        job_id, status, record, data, in_time = self.conn.execute("SELECT job_id,status,record,data,in_time FROM queue WHERE job_id= :job_id",
-                                         {"job_id": job_id}).fetchone()
-        return Job(job_id, status, record, json.loads(data), in_time)
+    def get_job_status(self, job_id: str, conn: Optional[sqlite3.Connection] = None) -> Job:
+        """
+        `conn` can be e.g. a read-only connection of another thread
+        """
+        conn = conn or self.conn
+        job_id, status, record, data, in_time, attempts, worker_id, priority = conn.execute(
+            "SELECT job_id,status,record,data,in_time,attempts,worker_id,priority FROM queue WHERE job_id= :job_id",
+            {"job_id": job_id}).fetchone()
+        return Job(job_id, status, record, json.loads(data), in_time, attempts, worker_id, priority)
 
 
 
 if __name__ == '__main__':
-    queue = Queue(Path('queue'))
+    queue = Queue(sqlite3.connect(Path('queue')))
 
     mode = sys.argv[1]
     if mode == "write":
@@ -99,8 +316,4 @@ if __name__ == '__main__':
             queue.put(job)
     elif mode == "read":
         while True:
-            job = queue.get_next_job()
-            if job is None:
-                time.sleep(.25)
-                continue
-            print(job)
+            print(queue.get())
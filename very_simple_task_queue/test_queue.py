@@ -0,0 +1,122 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+from very_simple_task_queue import Queue, JobStatus, JobPriority
+from very_simple_task_queue.notify import Notifier
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"), lease_duration=0.05, max_attempts=2)
+    job_id = q.put({"task": 1})
+    job = q.get_next_job("a")
+    assert job.id == job_id and job.attempts == 1
+    assert q.get_next_job("b") is None
+    time.sleep(0.1)
+    reclaimed = q.get_next_job("b")
+    assert reclaimed.id == job_id and reclaimed.worker_id == "b" and reclaimed.attempts == 2
+    # the first worker lost the job
+    assert not q.renew_lease(job)
+    assert not q.set_job_done(job)
+    assert not q.set_job_failed(job, "error")
+    assert q.get_job_status(job_id).status == JobStatus.IN_PROGRESS
+    time.sleep(0.1)
+    assert q.get_next_job("c") is None
+    assert q.get_job_status(job_id).status == JobStatus.FAILED
+
+
+def test_keep_alive_reports_lost_lease(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"), lease_duration=0.3)
+    q.put({"task": 1})
+    job = q.get_next_job("a")
+    with q.keep_alive(job) as lost:
+        time.sleep(0.5)
+        assert not lost.is_set()
+        q.conn.execute("UPDATE queue SET worker_id = 'b'")
+        q.conn.commit()
+        assert lost.wait(1)
+
+
+def test_failed_job_is_retried(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"), max_attempts=2)
+    job_id = q.put({"task": 1})
+    q.set_job_failed(q.get_next_job(), "error")
+    assert q.get_job_status(job_id).status == JobStatus.PENDING
+    q.set_job_failed(q.get_next_job(), "error")
+    assert q.get_job_status(job_id).status == JobStatus.FAILED
+
+    job_id = q.put({"task": 2})
+    q.set_job_failed(q.get_next_job(), "too large", retry=False)
+    assert q.get_job_status(job_id).status == JobStatus.FAILED
+
+
+def test_get_wakes_up_on_put(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"), poll_interval=30)
+    assert q.get(timeout=0.05) is None
+
+    def put_later():
+        time.sleep(0.1)
+        Queue(sqlite3.connect(tmp_path / "queue.db")).put({"task": 1})
+
+    thread = threading.Thread(target=put_later)
+    start = time.monotonic()
+    thread.start()
+    job = q.get(timeout=10)
+    thread.join()
+    assert job is not None
+    assert time.monotonic() - start < 5
+
+
+def test_status_notifier(tmp_path):
+    notifier = Notifier(tmp_path / "status-notify")
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"), status_notifier=notifier)
+    job_id = q.put({"task": 1})
+    other = q.put({"task": 2})
+
+    async def wait():
+        with notifier.listen(job_id) as listener:
+            assert not await listener.wait_async(0.05)
+            job = q.get_next_job()
+            assert await listener.wait_async(5)
+            # notifications about other jobs are ignored
+            q.set_job_done(q.get_next_job())
+            assert not await listener.wait_async(0.05)
+            q.set_job_done(job)
+            assert await listener.wait_async(5)
+
+    asyncio.run(wait())
+
+
+def test_dedup_and_priority(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"))
+    bulk = q.put({"task": "bulk"}, dedup_key="a", priority=JobPriority.BULK)
+    other = q.put({"task": "other"}, dedup_key="b", priority=JobPriority.NORMAL)
+    assert q.put({"task": "interactive"}, dedup_key="a", priority=JobPriority.INTERACTIVE) == bulk
+    job = q.get_next_job()
+    assert job.id == bulk and job.data == {"task": "interactive"}
+    # a job that is already running doesn't prevent a new one
+    assert q.put({"task": "again"}, dedup_key="a") not in (bulk, other)
+    assert q.get_next_job().id == other
+
+
+def test_failed_job_with_pending_duplicate(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"))
+    q.put({"task": 1}, dedup_key="a")
+    job = q.get_next_job()
+    pending = q.put({"task": 1}, dedup_key="a")
+    q.set_job_failed(job, "error")
+    assert q.get_job_status(job.id).status == JobStatus.FAILED
+    assert q.get_next_job().id == pending
+
+
+def test_one_running_job_per_record(tmp_path):
+    q = Queue(sqlite3.connect(tmp_path / "queue.db"))
+    q.put({"task": 1}, record="a")
+    q.put({"task": 2}, record="a")
+    other = q.put({"task": 3}, record="b")
+    job = q.get_next_job()
+    assert q.get_next_job().id == other
+    assert q.get_next_job() is None
+    q.set_job_done(job)
+    assert q.get_next_job().data == {"task": 2}